@@ -9,6 +9,10 @@ attention l'échelle horizontale est arbitraire (z = 0 -> 1ere abscisse
 z=max -> dernière abscisse
 '''
 
+from numpy import arange, array_equal, asarray, select
+from numpy.linalg import qr, lstsq
+from scipy.linalg import solve_triangular
+
 
 def bSpline3(z):
     if z <= 0:
@@ -72,3 +76,81 @@ def constantSpline(z, w):
         somme = somme + poids * bSpline0(z-index)
         index = index + 1
     return somme
+
+
+# =============================================================================
+# Vectorized basis matrix
+# =============================================================================
+def bSpline3_array(z):
+    z = asarray(z, dtype=float)
+    return select([z <= 0, z <= 1, z <= 2, z <= 3, z <= 4],
+                  [0., (z**3)/6,
+                   (2./3) + z * (-2 + z*(2 - z/2)),
+                   (-22./3) + z * (10 + z*(-4 + z/2)),
+                   (32./3) + z * (-8 + z*(2 - z/6))], 0.)
+
+
+def bSpline1_array(z):
+    z = asarray(z, dtype=float)
+    return select([z <= 0, z <= 1, z <= 2], [0., z, 2-z], 0.)
+
+
+def bSpline0_array(z):
+    z = asarray(z, dtype=float)
+    return select([z <= 0, z <= 1], [0., 1.], 0.)
+
+
+bSpline_array = {0: bSpline0_array, 1: bSpline1_array, 3: bSpline3_array}
+
+basis_cache = {}
+
+
+def spline_basis(alt, n_w, t, degree=3):
+    """
+    (len(alt) x n_w) matrix B of the B-splines of the given degree, such
+    that cubicSpline (degree 3) or constantSpline (degree 0) of the
+    weights w at the abscissae alt * (n_w - degree) / t is B.dot(w).
+    The matrices are cached on (degree, n_w, len(alt), t), the abscissae
+    being checked on each hit.
+    """
+    alt = asarray(alt, dtype=float)
+    key = (degree, int(n_w), len(alt), float(t))
+    if key in basis_cache:
+        alt_cached, B = basis_cache[key]
+        if array_equal(alt, alt_cached):
+            return B
+    z = alt * float(n_w - degree) / t
+    B = bSpline_array[degree](z[:, None] - arange(n_w)[None, :] + degree)
+    B.setflags(write=False)
+    if len(basis_cache) >= 32:
+        basis_cache.clear()
+    basis_cache[key] = (alt.copy(), B)
+    return B
+
+
+projection_cache = {}
+
+
+def spline_projection(alt, y, n_w, t, degree=3, skip=0, fixed=0.):
+    """
+    Weights w minimizing |B[:, skip:].dot(w) + fixed.sum(B[:, :skip]) - y|
+    with B = spline_basis(alt, n_w, t, degree): the first skip weights
+    are held at the value fixed. The problem is linear, it is solved
+    directly with the QR factorization of the basis, cached with it.
+    """
+    B = spline_basis(alt, n_w, t, degree)
+    A = B[:, skip:]
+    target = asarray(y, dtype=float) - fixed * B[:, :skip].sum(axis=1)
+    key = (id(B), skip)
+    if key in projection_cache and projection_cache[key][0] is B:
+        Q, R = projection_cache[key][1:]
+    else:
+        Q, R = qr(A)
+        if len(projection_cache) >= 32:
+            projection_cache.clear()
+        projection_cache[key] = (B, Q, R)
+    d = abs(R.diagonal())
+    if len(d) > len(target) or d.min() <= 1e-12 * d.max():
+        # some basis functions do not reach the abscissae
+        return lstsq(A, target, rcond=None)[0]
+    return solve_triangular(R, Q.T.dot(target))
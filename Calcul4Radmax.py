@@ -21,14 +21,15 @@ from collections import OrderedDict
 
 import os
 import Parameters4Radmax as p4R
-from Parameters4Radmax import P4Rm
+from Parameters4Radmax import P4Rm, current_project
 
 from Read4Radmax import ReadFile, SaveFile4Diff
 from Def_Strain4Radmax import f_strain, old2new_strain, fit_input_strain
 from Def_DW4Radmax import f_DW, old2new_DW, fit_input_DW
 from Def_XRD4Radmax import f_Refl
 from Def_Fh4Radmax import f_FH
-from Tools4Radmax import f_dhkl_V
+from Tools4Radmax import f_dhkl_V, structure_library
+from Functions4Radmax import Resol_convolution
 
 import logging
 logger = logging.getLogger(__name__)
@@ -59,6 +60,99 @@ pubsub_change_update_btn_state = "ChangeUpdateButtonState"
 pubsub_Fill_List_coef = "FillListCoef"
 
 
+# ------------------------------------------------------------------------------
+def calcul_parameters(a, name, name_s):
+    """
+    Fill the ParamDict of the project a with everything derived from its
+    settings: resolution, slices, structure factors of the crystal name
+    and of the substrate name_s, initial curves and profiles
+    """
+    a.ParamDict['par'] = np.concatenate((a.ParamDict['sp'],
+                                         a.ParamDict['dwp']), axis=0)
+    x_ = a.ParamDict['th']
+    param = a.ParamDict['param_func_profile']
+    a.ParamDict['resol'] = a.ParamDict['func_profile'](x_, param)
+    a.ParamDict['resol_conv'] = Resol_convolution(a.ParamDict['resol'],
+                                                  len(x_))
+
+    a.ParamDict['t_l'] = (a.AllDataDict['damaged_depth'] /
+                          a.AllDataDict['number_slices'])
+    a.ParamDict['z'] = (arange(a.AllDataDict['number_slices']+1) *
+                        a.ParamDict['t_l'])
+
+# =============================================================================
+# Material Data
+# =============================================================================
+    a.ParamDict['d'], a.ParamDict['Vol'] = f_dhkl_V(
+                                a.AllDataDict['h'], a.AllDataDict['k'],
+                                a.AllDataDict['l'], a.AllDataDict['a'],
+                                a.AllDataDict['b'], a.AllDataDict['c'],
+                                a.AllDataDict['alpha'],
+                                a.AllDataDict['beta'],
+                                a.AllDataDict['gamma'])
+    temp_1 = (a.ConstDict['re'] * a.AllDataDict['wavelength'] *
+              a.AllDataDict['wavelength'])
+    a.ParamDict['G'] = temp_1 / (np.pi * a.ParamDict['Vol'])
+    temp_2 = arcsin(a.AllDataDict['wavelength'] / (2*a.ParamDict['d']))
+    a.ParamDict['thB_S'] = temp_2
+    temp_3 = a.ConstDict['phi']
+    a.ParamDict['g0'] = sin(a.ParamDict['thB_S'] - temp_3)
+    a.ParamDict['gH'] = -sin(a.ParamDict['thB_S'] + temp_3)
+    a.ParamDict['b_S'] = a.ParamDict['g0'] / a.ParamDict['gH']
+    temp_4 = f_FH(a.AllDataDict['h'], a.AllDataDict['k'],
+                  a.AllDataDict['l'], a.AllDataDict['wavelength'],
+                  a.ParamDict['thB_S'], a.ParamDict['z'], name)
+    a.ParamDict['FH'] = temp_4[0]
+    a.ParamDict['FmH'] = temp_4[1]
+    a.ParamDict['F0'] = temp_4[2]
+
+# =============================================================================
+# Substrate Data
+# =============================================================================
+    a.ParamDict['d_s'], a.ParamDict['Vol_s'] = f_dhkl_V(
+                                a.AllDataDict['h_s'],
+                                a.AllDataDict['k_s'],
+                                a.AllDataDict['l_s'],
+                                a.AllDataDict['a_s'],
+                                a.AllDataDict['b_s'],
+                                a.AllDataDict['c_s'],
+                                a.AllDataDict['alpha_s'],
+                                a.AllDataDict['beta_s'],
+                                a.AllDataDict['gamma_s'])
+    temp_1 = (a.ConstDict['re'] * a.AllDataDict['wavelength'] *
+              a.AllDataDict['wavelength'])
+    a.ParamDict['G_s'] = temp_1 / (np.pi * a.ParamDict['Vol_s'])
+    temp_2 = arcsin(a.AllDataDict['wavelength'] /
+                    (2*a.ParamDict['d_s']))
+    a.ParamDict['thB_S_s'] = temp_2
+    temp_3 = a.ConstDict['phi_s']
+    a.ParamDict['g0_s'] = sin(a.ParamDict['thB_S_s'] - temp_3)
+    a.ParamDict['gH_s'] = -sin(a.ParamDict['thB_S_s'] + temp_3)
+    a.ParamDict['b_S_s'] = a.ParamDict['g0_s'] / a.ParamDict['gH_s']
+    temp_4 = f_FH(a.AllDataDict['h_s'], a.AllDataDict['k_s'],
+                  a.AllDataDict['l_s'],
+                  a.AllDataDict['wavelength'],
+                  a.ParamDict['thB_S_s'],
+                  a.ParamDict['z'], name_s)
+    a.ParamDict['FH_s'] = temp_4[0]
+    a.ParamDict['FmH_s'] = temp_4[1]
+    a.ParamDict['F0_s'] = temp_4[2]
+
+# =============================================================================
+    a.ParamDict['Ical'] = f_Refl(a.AllDataDict['geometry'], project=a)
+
+    a.ParamDict['I_i'] = (a.ParamDict['Ical'] / a.ParamDict['Ical'].max() +
+                          a.AllDataDict['background'])
+    a.ParamDict['depth'] = a.AllDataDict['damaged_depth'] - a.ParamDict['z']
+
+    a.ParamDict['DW_i'] = f_DW(a.ParamDict['z'], a.ParamDict['dwp'],
+                               a.AllDataDict['damaged_depth'],
+                               a.splinenumber[1])
+    a.ParamDict['strain_i'] = f_strain(a.ParamDict['z'], a.ParamDict['sp'],
+                                       a.AllDataDict['damaged_depth'],
+                                       a.splinenumber[0])
+
+
 # ------------------------------------------------------------------------------
 class Calcul4Radmax():
 
@@ -69,8 +163,9 @@ class Calcul4Radmax():
         we get back the files name, sort them by name
         and used them in the crsytal combobox
         """
-        if os.listdir(p4R.structures_name) != []:
-            P4Rm.crystal_list = sorted(list(os.listdir(p4R.structures_name)))
+        crystals = structure_library(p4R.structures_name).names()
+        if crystals != []:
+            P4Rm.crystal_list = crystals
         pub.sendMessage(pubsub_update_crystal_list)
 
     def on_load_project(self, paths):
@@ -91,6 +186,7 @@ class Calcul4Radmax():
             else:
                 P4Rm.AllDataDict[k] = datafromini[i]
             i += 1
+        P4Rm.AllDataDict.update(b.read_gsa_chains(paths))
 
         i = 0
         for name in ['Compound_name', 'substrate_name', 'DW_file',
@@ -274,6 +370,7 @@ class Calcul4Radmax():
         ncolumnFit = len(p4R.FitData)*[0, 0, 0, "", False, "",
                                        "", "", None, "", 1]
         P4Rm.AllDataDict = OrderedDict(zip(p4R.Exp_file_all_section, ncolumnAllData))
+        P4Rm.AllDataDict.update(p4R.GSAChainsDefault)
         P4Rm.ParamDict = OrderedDict(zip(p4R.Params4Radmax, ncolumnParam))
         P4Rm.PathDict = OrderedDict(zip(p4R.Path4Radmax, ncolumnPath))
         P4Rm.FitDict = OrderedDict(zip(p4R.FitData, ncolumnFit))
@@ -399,95 +496,7 @@ class Calcul4Radmax():
 
         if name != []:
             self.on_make_param_func()
-            P4Rm.ParamDict['par'] = np.concatenate((a.ParamDict['sp'],
-                                                    a.ParamDict['dwp']),
-                                                   axis=0)
-            x_ = a.ParamDict['th']
-            param = a.ParamDict['param_func_profile']
-            P4Rm.ParamDict['resol'] = a.ParamDict['func_profile'](x_, param)
-
-            P4Rm.ParamDict['t_l'] = (a.AllDataDict['damaged_depth'] /
-                                     a.AllDataDict['number_slices'])
-            P4Rm.ParamDict['z'] = (arange(a.AllDataDict['number_slices']+1) *
-                                   a.ParamDict['t_l'])
-
-# =============================================================================
-# Material Data
-# =============================================================================
-            P4Rm.ParamDict['d'], P4Rm.ParamDict['Vol'] = f_dhkl_V(
-                                        a.AllDataDict['h'], a.AllDataDict['k'],
-                                        a.AllDataDict['l'], a.AllDataDict['a'],
-                                        a.AllDataDict['b'], a.AllDataDict['c'],
-                                        a.AllDataDict['alpha'],
-                                        a.AllDataDict['beta'],
-                                        a.AllDataDict['gamma'])
-            temp_1 = (a.ConstDict['re'] * a.AllDataDict['wavelength'] *
-                      a.AllDataDict['wavelength'])
-            P4Rm.ParamDict['G'] = temp_1 / (np.pi * a.ParamDict['Vol'])
-            temp_2 = arcsin(a.AllDataDict['wavelength'] / (2*a.ParamDict['d']))
-            P4Rm.ParamDict['thB_S'] = temp_2
-            temp_3 = a.ConstDict['phi']
-            P4Rm.ParamDict['g0'] = sin(a.ParamDict['thB_S'] - temp_3)
-            P4Rm.ParamDict['gH'] = -sin(a.ParamDict['thB_S'] + temp_3)
-            P4Rm.ParamDict['b_S'] = a.ParamDict['g0'] / a.ParamDict['gH']
-            temp_4 = f_FH(a.AllDataDict['h'], a.AllDataDict['k'],
-                          a.AllDataDict['l'], a.AllDataDict['wavelength'],
-                          a.ParamDict['thB_S'], a.ParamDict['z'], name)
-            P4Rm.ParamDict['FH'] = temp_4[0]
-            P4Rm.ParamDict['FmH'] = temp_4[1]
-            P4Rm.ParamDict['F0'] = temp_4[2]
-
-# =============================================================================
-# Substrate Data
-# =============================================================================
-            P4Rm.ParamDict['d_s'], P4Rm.ParamDict['Vol_s'] = f_dhkl_V(
-                                        a.AllDataDict['h_s'],
-                                        a.AllDataDict['k_s'],
-                                        a.AllDataDict['l_s'],
-                                        a.AllDataDict['a_s'],
-                                        a.AllDataDict['b_s'],
-                                        a.AllDataDict['c_s'],
-                                        a.AllDataDict['alpha_s'],
-                                        a.AllDataDict['beta_s'],
-                                        a.AllDataDict['gamma_s'])
-            temp_1 = (a.ConstDict['re'] * a.AllDataDict['wavelength'] *
-                      a.AllDataDict['wavelength'])
-            P4Rm.ParamDict['G_s'] = temp_1 / (np.pi * a.ParamDict['Vol_s'])
-            temp_2 = arcsin(a.AllDataDict['wavelength'] /
-                            (2*a.ParamDict['d_s']))
-            P4Rm.ParamDict['thB_S_s'] = temp_2
-            temp_3 = a.ConstDict['phi_s']
-            P4Rm.ParamDict['g0_s'] = sin(a.ParamDict['thB_S_s'] - temp_3)
-            P4Rm.ParamDict['gH_s'] = -sin(a.ParamDict['thB_S_s'] + temp_3)
-            P4Rm.ParamDict['b_S_s'] = a.ParamDict['g0_s'] / a.ParamDict['gH_s']
-            temp_4 = f_FH(a.AllDataDict['h_s'], a.AllDataDict['k_s'],
-                          a.AllDataDict['l_s'],
-                          a.AllDataDict['wavelength'],
-                          a.ParamDict['thB_S_s'],
-                          a.ParamDict['z'], name_s)
-            P4Rm.ParamDict['FH_s'] = temp_4[0]
-            P4Rm.ParamDict['FmH_s'] = temp_4[1]
-            P4Rm.ParamDict['F0_s'] = temp_4[2]
-
-# =============================================================================
-            P4Rm.ParamDict['Ical'] = f_Refl(a.AllDataDict['geometry'])
-
-            P4Rm.ParamDict['I_i'] = (a.ParamDict['Ical'] /
-                                     a.ParamDict['Ical'].max() +
-                                     a.AllDataDict['background'])
-            P4Rm.ParamDict['depth'] = (a.AllDataDict['damaged_depth'] -
-                                       a.ParamDict['z'])
-
-            P4Rm.ParamDict['DW_i'] = f_DW(
-                                         a.ParamDict['z'],
-                                         a.ParamDict['dwp'],
-                                         a.AllDataDict['damaged_depth'],
-                                         spline_DW)
-            P4Rm.ParamDict['strain_i'] = f_strain(
-                                             a.ParamDict['z'],
-                                             a.ParamDict['sp'],
-                                             a.AllDataDict['damaged_depth'],
-                                             spline_strain)
+            calcul_parameters(current_project(), name, name_s)
             t = a.AllDataDict['damaged_depth']
 
             if a.AllDataDict['damaged_depth'] > 0:
@@ -498,10 +507,11 @@ class Calcul4Radmax():
             msg_ = "check if the structure file really exists"
             logger.log(logging.WARNING, msg_)
 
-    def f_strain_DW(self):
+    def f_strain_DW(self, par):
+        """Profiles of the GUI for the parameters par of a running fit"""
         a = P4Rm()
-        P4Rm.ParamDict['sp'] = a.ParamDict['_fp_min'][:int(a.AllDataDict['strain_basis_func'])]
-        P4Rm.ParamDict['dwp'] = a.ParamDict['_fp_min'][-1*int(a.AllDataDict['dw_basis_func']):]
+        P4Rm.ParamDict['sp'] = par[:int(a.AllDataDict['strain_basis_func'])]
+        P4Rm.ParamDict['dwp'] = par[-1*int(a.AllDataDict['dw_basis_func']):]
 
         P4Rm.ParamDict['DW_i'] = f_DW(
                                      a.ParamDict['z'], a.ParamDict['dwp'],
@@ -35,7 +35,7 @@ from sqlalchemy import Column, Integer, String, Float, BLOB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 
 import logging
 
@@ -99,6 +99,7 @@ class RadMaxData(Base):
     residual = Column(Float)
     geometry = Column(String)
     model = Column(String)
+    stop_reason = Column(String)
 
     alldata = Column(BLOB)
     spdata = Column(BLOB)
@@ -598,6 +599,7 @@ class DataBaseUse():
 
         self.create_engine(path)
         Base.metadata.create_all(a.DBDict['engine'])
+        self.upgrade_database()
 
         """ test size of the DB """
         statinfo = os.stat(path)
@@ -645,6 +647,18 @@ class DataBaseUse():
                                           str(geometry), str(model)))
         pub.sendMessage(pubsub_fill_list_DB, case=0, l=list_temp)
 
+    @staticmethod
+    def upgrade_database():
+        """Add the columns missing in a database of an older version"""
+        engine = P4Rm.DBDict['engine']
+        columns = [c['name'] for c in inspect(engine).get_columns(
+                   RadMaxData.__tablename__)]
+        if 'stop_reason' not in columns:
+            logger.log(logging.WARNING, "Adding stop_reason to the database")
+            with engine.begin() as connection:
+                connection.execute(text("ALTER TABLE RadMaxData "
+                                        "ADD COLUMN stop_reason VARCHAR"))
+
     @staticmethod
     def on_fill_database_and_list(success):
         a = P4Rm()
@@ -657,6 +671,7 @@ class DataBaseUse():
         residual = round(a.residual_error, 4)
         geometry = p4R.sample_geometry[int(a.AllDataDict['geometry'])]
         model = p4R.Strain_DW_choice[int(a.AllDataDict['model'])]
+        stop_reason = a.stop_reason
 
         alldata = pickle.dumps(a.AllDataDict, protocol=2)
         spdata = pickle.dumps(a.ParamDict['sp'], protocol=2)
@@ -667,6 +682,7 @@ class DataBaseUse():
         data = RadMaxData(date=date, exp_name=exp_name, crys_name=crys_name,
                           fit_algo=fit_algo, fit_success=fit_success,
                           residual=residual, geometry=geometry, model=model,
+                          stop_reason=stop_reason,
                           alldata=alldata, spdata=spdata, dwpdata=dwpdata,
                           pathDict=pathDict, xrd_data=xrd_data)
         P4Rm.DBDict['session'].add(data)
@@ -684,6 +700,8 @@ class DataBaseUse():
 
         read_exp = a.DBDict['session'].query(RadMaxData).filter(RadMaxData.date == date).one()
         P4Rm.AllDataDict = pickle.loads(read_exp.alldata)
+        # records of older versions have no GSA chains settings
+        P4Rm.AllDataDict.update(p4R.gsa_chains(a.AllDataDict))
         P4Rm.ParamDict['sp'] = pickle.loads(read_exp.spdata)
         P4Rm.ParamDict['dwp'] = pickle.loads(read_exp.dwpdata)
         P4Rm.PathDict = pickle.loads(read_exp.pathDict)
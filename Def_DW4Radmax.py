@@ -3,76 +3,43 @@
 # Author: A_BOULLE & M_SOUILAH
 # Radmax project
 
-from numpy import array, append, ones, zeros
+from numpy import array, asarray, ones, zeros
 from scipy.optimize import leastsq
-from BSplines4Radmax import constantSpline, cubicSpline
-from Functions4Radmax import f_pVoigt
+from BSplines4Radmax import spline_basis, spline_projection
+from Functions4Radmax import f_pVoigt, f_pVoigt_jac
 
 dwp_pv_initial = [0.5, 0.2, 0.1, 0.1, 0.1, 0.1, 0.85]
 
 
 def f_DW_spline3_smooth(alt, dwp, t):
-    w_DW_free = dwp[:]
-    w_DW = array([1.0, 1.0, 1.0])
-    w_DW = append(w_DW, w_DW_free)
-    N_abscisses = len(w_DW) - 3.
-    z = alt * N_abscisses / t
-    index = 0
-    DW = ones(len(z))
-    for i in z:
-        DW[index] = cubicSpline(i, w_DW)
-        index = index + 1
-    return DW
+    w_DW = asarray(dwp, dtype=float)
+    # the first three weights are fixed to 1 (no disorder at the bottom)
+    B = spline_basis(alt, len(w_DW) + 3, t, 3)
+    return B[:, :3].sum(axis=1) + B[:, 3:].dot(w_DW)
 
 
 def f_DW_spline3_smooth_lmfit(alt, pars, t):
-    w_DW_free = pars[-int(pars[1]):]
-    w_DW = array([1.0, 1.0, 1.0])
-    w_DW = append(w_DW, w_DW_free)
-    N_abscisses = len(w_DW) - 3.
-    z = alt * N_abscisses / t
-    index = 0
-    DW = ones(len(z))
-    for i in z:
-        DW[index] = cubicSpline(i, w_DW)
-        index = index + 1
-    return DW
+    return f_DW_spline3_smooth(alt, pars[-int(pars[1]):], t)
 
 
 def f_DW_spline3_abrupt(alt, dwp, t):
-    w_DW = dwp[:]
-    N_abscisses = len(w_DW) - 3.
-    z = alt * N_abscisses / t
-    index = 0
-    DW = ones(len(z))
-    for i in z:
-        DW[index] = cubicSpline(i, w_DW)
-        index = index + 1
-    return DW
+    w_DW = asarray(dwp, dtype=float)
+    B = spline_basis(alt, len(w_DW), t, 3)
+    return B.dot(w_DW)
 
 
 def f_DW_spline3_abrupt_lmfit(alt, pars, t):
-    w_DW = pars[-int(pars[1]):]
-    N_abscisses = len(w_DW) - 3.
-    z = alt * N_abscisses / t
-    index = 0
-    DW = ones(len(z))
-    for i in z:
-        DW[index] = cubicSpline(i, w_DW)
-        index = index + 1
-    return DW
+    return f_DW_spline3_abrupt(alt, pars[-int(pars[1]):], t)
 
 
 def f_DW_histogram(alt, dwp, t):
-    w_DW = dwp[:]
-    N_abscisses = len(w_DW)
-    z = alt * N_abscisses / t
-    index = 0
-    DW = ones(len(z))
-    for i in z:
-        DW[index] = constantSpline(i, w_DW)
-        index = index + 1
-    return DW
+    w_DW = asarray(dwp, dtype=float)
+    B = spline_basis(alt, len(w_DW), t, 0)
+    return B.dot(w_DW)
+
+
+def f_DW_histogram_lmfit(alt, pars, t):
+    return f_DW_histogram(alt, pars[-int(pars[1]):], t)
 
 
 def f_DW_pv(alt, pv_p, t):
@@ -126,12 +93,64 @@ def f_DW(alt, dwp, t, choice):
         DW = f_DW_spline3_smooth_lmfit(alt, dwp, t)
     elif choice == 6:
         DW = f_DW_spline3_abrupt_lmfit(alt, dwp, t)
+    elif choice == 7:
+        DW = f_DW_histogram_lmfit(alt, dwp, t)
     return DW
 
 
+def f_DW_jac(alt, dwp, t, choice):
+    """
+    Derivatives of the DW profile with respect to the coefficients,
+    as a (len(alt) x len(dwp)) array. The B-spline and histogram profiles
+    are affine in the weights, the asymmetric pv is differentiated
+    analytically.
+    """
+    dwp = array(dwp, dtype=float)
+    if choice == 2:
+        jac = zeros((len(alt), len(dwp)))
+        loc = dwp[1] * t
+        left = alt <= loc
+        right = ~left
+        d_l = f_pVoigt_jac(alt[left], [1-dwp[0], loc, dwp[2]*t, dwp[4]])
+        d_r = f_pVoigt_jac(alt[right], [dwp[6]-dwp[0], loc, dwp[3]*t,
+                                        dwp[5]])
+        jac[left, 0] = d_l[:, 0]
+        jac[left, 1] = -d_l[:, 1] * t
+        jac[left, 2] = -d_l[:, 2] * t
+        jac[left, 4] = -d_l[:, 3]
+        jac[right, 0] = d_r[:, 0]
+        jac[right, 1] = -d_r[:, 1] * t
+        jac[right, 3] = -d_r[:, 2] * t
+        jac[right, 5] = -d_r[:, 3]
+        jac[right, 6] = 1. - d_r[:, 0]
+        return jac
+    jac = zeros((len(alt), len(dwp)))
+    offset = f_DW(alt, zeros(len(dwp)), t, choice)
+    for j in range(len(dwp)):
+        w = zeros(len(dwp))
+        w[j] = 1.
+        jac[:, j] = f_DW(alt, w, t, choice) - offset
+    return jac
+
+
+# spline profiles: degree of the B-splines and number of fixed weights
+spline_choice = {0: (3, 3), 1: (3, 0), 3: (0, 0)}
+
+
+def project_DW(alt, DW, size, t, choice):
+    """
+    Spline coefficients of the DW profile closest to DW, in the
+    least-squares sense (linear problem, solved directly)
+    """
+    degree, skip = spline_choice[choice]
+    return spline_projection(alt, DW, int(size) + skip, t, degree, skip, 1.)
+
+
 def old2new_DW(alt, dwp, t, new_size, choice):
-    dwp_guess = ones(new_size)
     dw_old = f_DW(alt, dwp, t, choice)
+    if choice in spline_choice:
+        return project_DW(alt, dw_old, new_size, t, choice)
+    dwp_guess = ones(new_size)
 
     def errfunc(dwp, alt, dw, t): return f_DW(alt, dwp, t, choice) - dw_old
     dwp_new, success = leastsq(errfunc, dwp_guess, args=(alt, dw_old, t))
@@ -144,7 +163,9 @@ def fit_input_DW(data, size, t, choice):
     depth = data[0]
     DW = data[1]
 
-    if choice == 2:
+    if choice in spline_choice:
+        return project_DW(t - depth, DW, size, t, choice)
+    elif choice == 2:
         dwp = dwp_pv_initial
         t = depth.max()
     else:
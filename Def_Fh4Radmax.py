@@ -4,12 +4,13 @@
 # Radmax project
 
 import os
-from numpy import loadtxt, ones, array, shape
-from scipy.interpolate import interp1d
-from scipy import exp, pi, sin
+from numpy import (ones, zeros, arange, repeat, concatenate, atleast_1d,
+                   atleast_2d, asarray, broadcast_to, einsum, where, nan)
+from scipy import exp, pi, sin, arcsin
 
 import Parameters4Radmax as p4R
-from Tools4Radmax import csv2dic_f0, csv2dic_el, read_structure
+from Tools4Radmax import structure_library, f_dhkl_V
+from Scattering4Radmax import scattering_table
 
 
 # Anomalous scattering factors
@@ -21,52 +22,92 @@ def f_f1f2(wl, el):
     Ewl = h*c / (wl*1e-10*e)
     if len(el[:-2:]) > 0:
         el = el[:-2]
-    Z = int(csv2dic_el(os.path.join(p4R.struc_factors, "elements.csv"))[el])
-    f = loadtxt(os.path.join(p4R.struc_factors, el + ".txt"))
-    E = f[:, 0]
-    f1 = f[:, 1]
-    f2 = f[:, 2]
-    f1_interp = interp1d(E, f1)(Ewl)
-    f2_interp = interp1d(E, f2)(Ewl)
-
-    return float(f1_interp)-Z + float(f2_interp)*1j
+    return complex(scattering_table().f1f2([el], Ewl)[0, 0])
 
 
 # Atomic scattering factor
 def f_f0(th, wl, el):
-    coeff = csv2dic_f0(os.path.join(p4R.struc_factors, "f0_all.csv"))[el]
-    n = 0
-    sum_ = coeff[5]
-    while n <= 4:
-        sum_ = sum_ + coeff[n] * exp(-coeff[n+6] * (sin(th) / wl)**2)
-        n = n+1
-    return sum_
+    return float(scattering_table().f0([el], sin(th) / wl)[0, 0])
 
 
 def asf(th, wl, el):
-    return f_f0(th, wl, el) + f_f1f2(wl, el), f_f0(0, wl, el) + f_f1f2(wl, el)
+    f, f0 = scattering_table().asf([el], th, wl)
+    return complex(f[0, 0]), complex(f0[0, 0])
+
+
+# structure factors already computed, keyed on the crystal, the reflection,
+# the wavelength, the Bragg angle and the date of the structure file
+sf_cache = {}
 
 
 def structure_factor(h, k, l, wl, thB_S, alt, crystal_name):
-    el, xyz = read_structure(os.path.join(p4R.structures_name, crystal_name))
-    i = 0
-    f, f0 = [None]*len(el), [None]*len(el)
-    FH, FmH, F0 = [None]*len(el), [None]*len(el), [None]*len(el)
-    while i < len(el):
-        if len(shape(xyz[i]))==1:
-            xyz[i]=xyz[i].reshape(1,3)
-        f[i], f0[i] = asf(thB_S, wl, el[i])
-        FH[i] = f[i]*exp(-2j*pi*(h*xyz[i][:, 0] + k*xyz[i][:, 1] +
-                         l*xyz[i][:, 2])).sum()
-        FmH[i] = f[i]*exp(2j*pi*(h*xyz[i][:, 0] + k*xyz[i][:, 1] +
-                          l*xyz[i][:, 2])).sum()
-        F0[i] = f0[i]*shape(xyz[i])[0]
-        i += 1
-    FHo, FmHo, F0o = array(FH).sum(), array(FmH).sum(), array(F0).sum()
+    path = os.path.join(p4R.structures_name, crystal_name)
+    key = (crystal_name, h, k, l, wl, float(thB_S), os.path.getmtime(path))
+    if key not in sf_cache:
+        sf_cache[key] = unit_cell_factor(h, k, l, wl, thB_S, crystal_name)
+    FHo, FmHo, F0o = sf_cache[key]
     FH, FmH, F0 = ones(len(alt))*FHo, ones(len(alt))*FmHo, ones(len(alt))*F0o
     return FH, FmH, F0
 
 
+def unit_cell_factor(h, k, l, wl, thB_S, crystal_name):
+    """FH, FmH and F0 of the unit cell of a crystal for one reflection"""
+    FH, FmH, F0 = structure_factors([[h, k, l]], wl, thB_S, crystal_name)
+    return FH[0, 0], FmH[0, 0], F0[0, 0]
+
+
+def cell_factors(hkl, wl, thB, structure):
+    """
+    FH, FmH and F0 of the unit cell structure = (elements, coordinates) for
+    the M reflections hkl (M x 3) and the W wavelengths wl, thB being the
+    Bragg angles, broadcast to (M x W). The phase factors of all the atoms
+    are summed per element with one matrix product.
+    """
+    el, xyz = structure
+    hkl = atleast_2d(asarray(hkl, dtype=float))
+    wl = atleast_1d(asarray(wl, dtype=float))
+    thB = broadcast_to(thB, (len(hkl), len(wl)))
+    xyz = [atleast_2d(x) for x in xyz]
+    pos = concatenate(xyz)
+    owner = zeros((len(pos), len(el)))
+    owner[arange(len(pos)), repeat(arange(len(el)), [len(x) for x in xyz])] = 1
+    phase = exp(-2j*pi*hkl.dot(pos.T)).dot(owner)
+    phase_m = exp(2j*pi*hkl.dot(pos.T)).dot(owner)
+    f, f0 = scattering_table().asf(el, thB, wl[None, :])
+    FH = einsum('me,emw->mw', phase, f)
+    FmH = einsum('me,emw->mw', phase_m, f)
+    F0 = einsum('e,emw->mw', owner.sum(axis=0), f0)
+    return FH, FmH, F0
+
+
+def structure_factors(hkl, wl, thB, crystal_name):
+    """
+    FH, FmH and F0 (M x W arrays) of a crystal of the structures directory
+    for M reflections hkl (M x 3), W wavelengths wl and the Bragg angles thB
+    """
+    library = structure_library(p4R.structures_name)
+    return cell_factors(hkl, wl, thB, library.structure(crystal_name))
+
+
+def reflection_table(hkl, wl, crystal_name, a, b, c, alpha, beta, gamma):
+    """
+    Planar spacing (M), Bragg angles, FH, FmH and F0 (M x W) of the
+    reflections hkl (M x 3) for the wavelengths wl and the given lattice;
+    reflections out of reach at a wavelength (wl > 2d) are set to nan
+    """
+    hkl = atleast_2d(asarray(hkl, dtype=float))
+    wl = atleast_1d(asarray(wl, dtype=float))
+    d, V = f_dhkl_V(hkl[:, 0], hkl[:, 1], hkl[:, 2], a, b, c,
+                    alpha, beta, gamma)
+    ratio = wl[None, :] / (2*d[:, None])
+    reach = ratio <= 1
+    thB = arcsin(where(reach, ratio, 1.))
+    FH, FmH, F0 = structure_factors(hkl, wl, thB, crystal_name)
+    for F in (thB, FH, FmH, F0):
+        F[~reach] = nan
+    return d, thB, FH, FmH, F0
+
+
 def f_FH(h, k, l, wl, thB_S, alt, crystal_name):
     """
     Replace name with appropriate material
@@ -3,76 +3,43 @@
 # Author: A_BOULLE & M_SOUILAH
 # Radmax project
 
-from numpy import array, append, ones, zeros
+from numpy import array, asarray, ones, zeros
 from scipy.optimize import leastsq
-from BSplines4Radmax import constantSpline, cubicSpline
-from Functions4Radmax import f_pVoigt
+from BSplines4Radmax import spline_basis, spline_projection
+from Functions4Radmax import f_pVoigt, f_pVoigt_jac
 
 sp_pv_initial = [2, 0.2, 0.1, 0.1, 0.1, 0.1, 0.05]
 
 
 def f_strain_spline3_smooth(alt, sp, t):
-    w_strain_free = sp[:]
-    w_strain = array([0.0, 0.0, 0.0])
-    w_strain = append(w_strain, w_strain_free)
-    N_abscisses = len(w_strain) - 3.
-    z = alt * N_abscisses / t
-    index = 0
-    strain = ones(len(z))
-    for i in z:
-        strain[index] = cubicSpline(i, w_strain) / 100.
-        index = index + 1
-    return strain
+    w_strain = asarray(sp, dtype=float)
+    # the first three weights are fixed to 0 (no strain at the bottom)
+    B = spline_basis(alt, len(w_strain) + 3, t, 3)
+    return B[:, 3:].dot(w_strain) / 100.
 
 
 def f_strain_spline3_smooth_lmfit(alt, pars, t):
-    w_strain_free = pars[2:int(pars[0])+2]
-    w_strain = array([0.0, 0.0, 0.0])
-    w_strain = append(w_strain, w_strain_free)
-    N_abscisses = len(w_strain) - 3.
-    z = alt * N_abscisses / t
-    index = 0
-    strain = ones(len(z))
-    for i in z:
-        strain[index] = cubicSpline(i, w_strain) / 100.
-        index = index + 1
-    return strain
+    return f_strain_spline3_smooth(alt, pars[2:int(pars[0])+2], t)
 
 
 def f_strain_spline3_abrupt(alt, sp, t):
-    w_strain = sp[:]
-    N_abscisses = len(w_strain) - 3.
-    z = alt * N_abscisses / t
-    index = 0
-    strain = ones(len(z))
-    for i in z:
-        strain[index] = cubicSpline(i, w_strain) / 100.
-        index = index + 1
-    return strain
+    w_strain = asarray(sp, dtype=float)
+    B = spline_basis(alt, len(w_strain), t, 3)
+    return B.dot(w_strain) / 100.
 
 
 def f_strain_spline3_abrupt_lmfit(alt, pars, t):
-    w_strain = pars[2:int(pars[0])+2]
-    N_abscisses = len(w_strain) - 3.
-    z = alt * N_abscisses / t
-    index = 0
-    strain = ones(len(z))
-    for i in z:
-        strain[index] = cubicSpline(i, w_strain) / 100.
-        index = index + 1
-    return strain
+    return f_strain_spline3_abrupt(alt, pars[2:int(pars[0])+2], t)
 
 
 def f_strain_histogram(alt, sp, t):
-    w_strain = sp[:]
-    N_abscisses = len(w_strain)
-    z = alt * N_abscisses / t
-    index = 0
-    strain = ones(len(z))
-    for i in z:
-        strain[index] = constantSpline(i, w_strain) / 100.
-        index = index + 1
-    return strain
+    w_strain = asarray(sp, dtype=float)
+    B = spline_basis(alt, len(w_strain), t, 0)
+    return B.dot(w_strain) / 100.
+
+
+def f_strain_histogram_lmfit(alt, pars, t):
+    return f_strain_histogram(alt, pars[2:int(pars[0])+2], t)
 
 
 def f_strain_pv(alt, pv_p, t):
@@ -122,12 +89,63 @@ def f_strain(alt, sp, t, choice):
         strain = f_strain_spline3_smooth_lmfit(alt, sp, t)
     elif choice == 6:
         strain = f_strain_spline3_abrupt_lmfit(alt, sp, t)
+    elif choice == 7:
+        strain = f_strain_histogram_lmfit(alt, sp, t)
     return strain
 
 
+def f_strain_jac(alt, sp, t, choice):
+    """
+    Derivatives of the strain profile with respect to the coefficients,
+    as a (len(alt) x len(sp)) array. The B-spline and histogram profiles
+    are linear in the weights, the asymmetric pv is differentiated
+    analytically.
+    """
+    sp = array(sp, dtype=float)
+    if choice == 2:
+        jac = zeros((len(alt), len(sp)))
+        loc = sp[1] * t
+        left = alt <= loc
+        right = ~left
+        d_l = f_pVoigt_jac(alt[left], [sp[0], loc, sp[2]*t, sp[4]])
+        d_r = f_pVoigt_jac(alt[right], [sp[0]-sp[6], loc, sp[3]*t, sp[5]])
+        jac[left, 0] = d_l[:, 0]
+        jac[left, 1] = d_l[:, 1] * t
+        jac[left, 2] = d_l[:, 2] * t
+        jac[left, 4] = d_l[:, 3]
+        jac[right, 0] = d_r[:, 0]
+        jac[right, 1] = d_r[:, 1] * t
+        jac[right, 3] = d_r[:, 2] * t
+        jac[right, 5] = d_r[:, 3]
+        jac[right, 6] = 1. - d_r[:, 0]
+        return jac / 100.
+    jac = zeros((len(alt), len(sp)))
+    for j in range(len(sp)):
+        w = zeros(len(sp))
+        w[j] = 1.
+        jac[:, j] = f_strain(alt, w, t, choice)
+    return jac
+
+
+# spline profiles: degree of the B-splines and number of fixed weights
+spline_choice = {0: (3, 3), 1: (3, 0), 3: (0, 0)}
+
+
+def project_strain(alt, strain, size, t, choice):
+    """
+    Spline coefficients of the strain profile closest to strain, in the
+    least-squares sense (linear problem, solved directly)
+    """
+    degree, skip = spline_choice[choice]
+    return spline_projection(alt, 100. * asarray(strain), int(size) + skip,
+                             t, degree, skip, 0.)
+
+
 def old2new_strain(alt, sp, t, new_size, choice):
-    sp_guess = ones(int(new_size))
     strain_old = f_strain(alt, sp, t, choice)
+    if choice in spline_choice:
+        return project_strain(alt, strain_old, new_size, t, choice)
+    sp_guess = ones(int(new_size))
 
     def errfunc(sp, alt, strain, t):
         return f_strain(alt, sp, t, choice) - strain_old
@@ -142,7 +160,9 @@ def fit_input_strain(data, size, t, choice):
     depth = data[0]
     strain = data[1]
 
-    if choice == 2:
+    if choice in spline_choice:
+        return project_strain(t - depth, strain, size, t, choice)
+    elif choice == 2:
         sp = sp_pv_initial
         t = depth.max()
     else:
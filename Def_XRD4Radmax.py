@@ -5,502 +5,373 @@
 
 from Def_Strain4Radmax import f_strain
 from Def_DW4Radmax import f_DW
-from Parameters4Radmax import P4Rm
-from scipy import tan, exp, sin, pi, convolve, sqrt
-from Tools4Radmax import signe
+from Parameters4Radmax import current_project
+from scipy import tan, exp, sqrt
+from numpy import (atleast_2d, zeros, ones, concatenate, array_split, arange,
+                   maximum, add, subtract, multiply, divide)
+from numpy import sqrt as np_sqrt, exp as np_exp
+from multiprocessing.pool import ThreadPool
+from Plan4Radmax import geometry_plan
 
 # =============================================================================
 # Calcul de la réflectivité dynamique
 # =============================================================================
 
 
-def f_Refl(choice, Data=None):
-    a = P4Rm()
-    if a.AllDataDict['damaged_depth'] > 0:
-        if choice == 0:
-            res = f_Refl_Default()
-        elif choice == 1:
-            res = f_Refl_Thin_Film()
-        elif choice == 2:
-            res = f_Refl_Thick_Film()
-        elif choice == 3:
-            res = f_Refl_Thick_Film_and_Substrate()
-    else:
-        res = f_Refl_Substrate()
-    return res
-
-
-def f_Refl_fit(choice, Data=None):
-    if choice == 0:
-        res = f_Refl_Default_fit(Data)
-    elif choice == 1:
-        res = f_Refl_Thin_Film_fit(Data)
-    elif choice == 2:
-        res = f_Refl_Thick_Film_fit(Data)
-    elif choice == 3:
-        res = f_Refl_Thick_Film_and_Substrate_fit(Data)
-    return res
-
-
-# =============================================================================
-# # # # # # For Fit ONLY
-# =============================================================================
-
-# =============================================================================
-# label_1 = "Default"
-# =============================================================================
-def f_Refl_Default_fit(Data):
-    strain = Data[0]
-    DW = Data[1]
-
-    dat = Data[2]
-    wl = dat[0]
-    N = dat[2]
-
-    phi = dat[3]
-    t_l = dat[4]
-    b_S = dat[5]
-    thB_S = dat[6]
-    G = dat[7]
-    F0 = dat[8]
-    FH = dat[9]
-    FmH = dat[10]
-    th = dat[19]
-
-    thB = thB_S - strain * tan(thB_S)  # angle de Bragg dans chaque lamelle
-    eta = ((-b_S*(th-thB_S)*sin(2*thB_S) - 0.5*G*F0[0]*(1-b_S)) /
-           ((abs(b_S)**0.5) * G * (FH[0]*FmH[0])**0.5))
-    res = (eta - signe(eta.real)*((eta*eta - 1)**0.5))
-
-    n = 1
-    while (n <= N):
-        g0 = sin(thB[n] - phi)  # gamma 0
-        gH = -sin(thB[n] + phi)  # gamma H
-        b = g0 / gH
-        T = (pi * G * ((FH[n] * FmH[n])**0.5) * t_l * DW[n] /
-             (wl * (abs(g0 * gH)**0.5)))
-        eta = ((-b*(th-thB[n])*sin(2*thB_S) - 0.5*G*F0[n]*(1-b)) /
-               ((abs(b)**0.5) * G * DW[n] * (FH[n]*FmH[n])**0.5))
-        S1 = (res - eta + sqrt(eta*eta-1))*exp(-1j*T*sqrt(eta*eta-1))
-        S2 = (res - eta - sqrt(eta*eta-1))*exp(1j*T*sqrt(eta*eta-1))
-        res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-        n += 1
-    return res
-
-
-# =============================================================================
-# label_2 = "Thin film"
-# =============================================================================
-def f_Refl_Thin_Film_fit(Data):
-    strain = Data[0]
-    DW = Data[1]
-
-    dat = Data[2]
-    wl = dat[0]
-    N = dat[2]
-
-    phi = dat[3]
-    t_l = dat[4]
-    thB_S = dat[6]
-    G = dat[7]
-    F0 = dat[8]
-    FH = dat[9]
-    FmH = dat[10]
-    th = dat[19]
-
-    thB = thB_S - strain * tan(thB_S)  # angle de Bragg dans chaque lamelle
-
-    eta = 0
-    res = 0
-
-    n = 1
-    while (n <= N):
-        g0 = sin(thB[n] - phi)  # gamma 0
-        gH = -sin(thB[n] + phi)  # gamma H
-        b = g0 / gH
-        T = pi * G * ((FH[n]*FmH[n])**0.5) * t_l * DW[n] / (wl * (abs(g0*gH)**0.5))
-        eta = (-b*(th-thB[n])*sin(2*thB_S) - 0.5*G*F0[n]*(1-b)) / ((abs(b)**0.5) * G * DW[n] * (FH[n]*FmH[n])**0.5)
-        S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-        S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-        res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-        n += 1
-    return res
-
-
-# =============================================================================
-# label_3 = "Thick film"
-# =============================================================================
-def f_Refl_Thick_Film_fit(Data):
-    strain = Data[0]
-    DW = Data[1]
-
-    dat = Data[2]
-    wl = dat[0]
-    t = dat[1]
-    N = dat[2]
-
-    phi = dat[3]
-    t_l = dat[4]
-    thB_S = dat[6]
-    G = dat[7]
-    F0 = dat[8]
-    FH = dat[9]
-    FmH = dat[10]
-    t_film = dat[17]
-    th = dat[19]
-    delta_t = t_film - t
-
-    thB = thB_S - strain * tan(thB_S)  # angle de Bragg dans chaque lamelle
-
-    eta = 0
-    res = 0
-
-    g0 = sin(thB[0] - phi)  # gamma 0
-    gH = -sin(thB[0] + phi)  # gamma H
-    b = g0 / gH
-    T = pi * G * ((FH[0]*FmH[0])**0.5) * delta_t / (wl * (abs(g0*gH)**0.5))
-    eta = (-b*(th-thB[0])*sin(2*thB_S) - 0.5*G*F0[0]*(1-b)) / ((abs(b)**0.5) * G  * (FH[0]*FmH[0])**0.5)
-    S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-    S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-    res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-
-    n = 1
-    while (n <= N):
-        g0 = sin(thB[n] - phi)  # gamma 0
-        gH = -sin(thB[n] + phi)  # gamma H
-        b = g0 / gH
-        T = pi * G * ((FH[n]*FmH[n])**0.5) * t_l * DW[n] / (wl * (abs(g0*gH)**0.5))
-        eta = (-b*(th-thB[n])*sin(2*thB_S) - 0.5*G*F0[n]*(1-b)) / ((abs(b)**0.5) * G * DW[n] * (FH[n]*FmH[n])**0.5)
-        S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-        S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-        res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-        n += 1
-    return res
-
-
-# =============================================================================
-# label_4 = "Thick film + substrate"
-# =============================================================================
-def f_Refl_Thick_Film_and_Substrate_fit(Data):
-    strain = Data[0]
-    DW = Data[1]
-
-    dat = Data[2]
-    wl = dat[0]
-    t = dat[1]
-    N = dat[2]
-
-    phi = dat[3]
-    t_l = dat[4]
-    thB_S = dat[6]
-    G = dat[7]
-    F0 = dat[8]
-    FH = dat[9]
-    FmH = dat[10]
-
-    b_Sub = dat[11]
-    thB_Sub = dat[12]
-    G_Sub = dat[13]
-    F0_Sub = dat[14]
-    FH_Sub = dat[15]
-    FmH_Sub = dat[16]
-
-    t_film = dat[17]
-    dw_film = dat[18]
-    th = dat[19]
-    delta_t = t_film - t
-
-    thB = thB_S - strain * tan(thB_S)  # angle de Bragg dans chaque lamelle
-
-    temp1 = -b_Sub*(th-thB_Sub)*sin(2*thB_Sub) - (0.5*G_Sub*F0_Sub[0]*(1-b_Sub))
-    temp2 = (abs(b_Sub)**0.5) * G_Sub * (FH_Sub[0]*FmH_Sub[0])**0.5
-    eta = temp1/temp2
-    res = (eta - signe(eta.real)*((eta*eta - 1)**0.5))
-
-    g0 = sin(thB[0] - phi)  # gamma 0
-    gH = -sin(thB[0] + phi)  # gamma H
-    b = g0 / gH
-    T = pi * G * ((FH[0]*FmH[0])**0.5) * delta_t * dw_film / (wl * (abs(g0*gH)**0.5))
-    eta = (-b*(th-thB[0])*sin(2*thB_S) - 0.5*G*F0[0]*(1-b)) / ((abs(b)**0.5) * G  * dw_film * (FH[0]*FmH[0])**0.5)
-    S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-    S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-    res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-
-    n = 1
-    while (n <= N):
-        g0 = sin(thB[n] - phi)  # gamma 0
-        gH = -sin(thB[n] + phi)  # gamma H
-        b = g0 / gH
-        T = pi * G * ((FH[n]*FmH[n])**0.5) * t_l * DW[n] * dw_film / (wl * (abs(g0*gH)**0.5))
-        eta = (-b*(th-thB[n])*sin(2*thB_S) - 0.5*G*F0[n]*(1-b)) / ((abs(b)**0.5) * G * DW[n] * dw_film * (FH[n]*FmH[n])**0.5 )
-        S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-        S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-        res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-        n += 1
-    return res
-
-
-# =============================================================================
-# Only substrate for t=0 --> damaged depth
-# =============================================================================
-def f_Refl_Substrate_fit(Data):
-    a = P4Rm()
-
-    G = a.ParamDict['G']
-    thB_S = a.ParamDict['thB_S']
-    resol = a.ParamDict['resol']
-    b_S = a.ParamDict['b_S']
-    FH = a.ParamDict['FH']
-    FmH = a.ParamDict['FmH']
-    F0 = a.ParamDict['F0']
-    th = a.ParamDict['th']	
-    eta = (-b_S*(th-thB_S)*sin(2*thB_S) - 0.5*G*F0[0]*(1-b_S)) / ((abs(b_S)**0.5) * G * (FH[0]*FmH[0])**0.5)
-    res = (eta - signe(eta.real)*((eta*eta - 1)**0.5)) * (FH[0] / FmH[0])**0.5
-    return convolve(abs(res)**2, resol, mode='same')
-
-# =============================================================================
-# # # # # #
-# =============================================================================
-
-
-# =============================================================================
-# label_1 = "Default"
-# =============================================================================
-def f_Refl_Default():
-    a = P4Rm()
-
-    wl = a.AllDataDict['wavelength']
+def f_Refl(choice, Data=None, project=None):
+    """
+    Intensity diffracted by the model of project (by default the project
+    of the GUI), convolved with the instrumental resolution
+    """
+    if project is None:
+        project = current_project()
+    a = project
     t = a.AllDataDict['damaged_depth']
-    N = a.AllDataDict['number_slices']
-
-    G = a.ParamDict['G']
-    thB_S = a.ParamDict['thB_S']
-    resol = a.ParamDict['resol']
-    b_S = a.ParamDict['b_S']
-    phi = a.ConstDict['phi']
-    t_l = a.ParamDict['t_l']
     z = a.ParamDict['z']
-    FH = a.ParamDict['FH']
-    FmH = a.ParamDict['FmH']
-    F0 = a.ParamDict['F0']
     sp = a.ParamDict['sp']
     dwp = a.ParamDict['dwp']
-    th = a.ParamDict['th']
-    spline_DW = a.splinenumber[1]
-    spline_strain = a.splinenumber[0]
     param = a.ParamDict['par']
 
-    strain = f_strain(z, param[:len(sp):], t, spline_strain)
-    DW = f_DW(z, param[len(sp):len(sp)+len(dwp):], t, spline_DW)
-
-    thB = thB_S - strain * tan(thB_S)  # angle de Bragg dans chaque lamelle
-    eta = ((-b_S*(th-thB_S)*sin(2*thB_S) - 0.5*G*F0[0]*(1-b_S)) /
-           ((abs(b_S)**0.5) * G * (FH[0]*FmH[0])**0.5))
-    res = (eta - signe(eta.real)*((eta*eta - 1)**0.5))
-
-    n = 1
-    while (n <= N):
-        g0 = sin(thB[n] - phi)  # gamma 0
-        gH = -sin(thB[n] + phi)  # gamma H
-        b = g0 / gH
-        T = (pi * G * ((FH[n] * FmH[n])**0.5) * t_l * DW[n] /
-             (wl * (abs(g0 * gH)**0.5)))
-        eta = ((-b*(th-thB[n])*sin(2*thB_S) - 0.5*G*F0[n]*(1-b)) /
-               ((abs(b)**0.5) * G * DW[n] * (FH[n]*FmH[n])**0.5))
-        S1 = (res - eta + sqrt(eta*eta-1))*exp(-1j*T*sqrt(eta*eta-1))
-        S2 = (res - eta - sqrt(eta*eta-1))*exp(1j*T*sqrt(eta*eta-1))
-        res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-        n += 1
-    return convolve(abs(res)**2, resol, mode='same')
+    if t > 0:
+        strain = f_strain(z, param[:len(sp):], t, a.splinenumber[0])
+        DW = f_DW(z, param[len(sp):len(sp)+len(dwp):], t, a.splinenumber[1])
+    else:
+        strain = zeros(len(z))
+        DW = ones(len(z))
+    res = f_Refl_fit(choice, [strain, DW, f_plan(choice, project)])
+    return a.ParamDict['resol_conv'](abs(res)**2)
+
+
+def f_plan(choice, project=None):
+    """
+    Simulation plan of the geometry choice for the model of project (by
+    default the project of the GUI)
+    """
+    if project is None:
+        project = current_project()
+    a = project
+    return geometry_plan(
+        choice, a.AllDataDict['wavelength'], a.AllDataDict['damaged_depth'],
+        a.AllDataDict['number_slices'], a.ConstDict['phi'],
+        a.ParamDict['t_l'], a.ParamDict['b_S'], a.ParamDict['thB_S'],
+        a.ParamDict['G'], a.ParamDict['F0'], a.ParamDict['FH'],
+        a.ParamDict['FmH'], a.ParamDict['th'],
+        b_Sub=a.ParamDict['b_S_s'], thB_Sub=a.ParamDict['thB_S_s'],
+        G_Sub=a.ParamDict['G_s'], F0_Sub=a.ParamDict['F0_s'],
+        FH_Sub=a.ParamDict['FH_s'], FmH_Sub=a.ParamDict['FmH_s'],
+        t_film=a.AllDataDict['film_thick'],
+        dw_film=a.AllDataDict['dw_thick'])
+
+
+def f_Refl_fit(choice, Data):
+    """
+    Amplitude reflected by the stack described by the simulation plan
+    Data[2] (see Plan4Radmax) for the strain and DW profiles Data[0] and
+    Data[1]; the profiles may also be (K x N+1) stacks, one row per
+    candidate, a (K x len(th)) block of amplitudes is then returned.
+    """
+    plan = Data[2]
+    alpha, beta, T = plan.slices(Data[0], Data[1])
+    th = plan.th
+    res = plan.res0
+    for j in range(plan.L):
+        res = _slice(res, alpha[..., j, None]*th + beta[..., j, None],
+                     T[..., j, None])
+    return res
 
 
-# =============================================================================
-# label_2 = "Thin film"
-# =============================================================================
-def f_Refl_Thin_Film():
-    a = P4Rm()
+def f_Refl_fit_batch(choice, Data):
+    """
+    Batched twin of f_Refl_fit: Data[0] and Data[1] are (K x N+1) stacks of
+    strain and DW profiles, Data[2] is the simulation plan.
+    The slice recurrence runs once over (K x len(th)) arrays and a
+    (K x len(th)) block of amplitudes is returned, one row per candidate.
+    """
+    return f_Refl_fit(choice, [atleast_2d(Data[0]), atleast_2d(Data[1]),
+                               Data[2]])
 
-    wl = a.AllDataDict['wavelength']
-    t = a.AllDataDict['damaged_depth']
-    N = a.AllDataDict['number_slices']
 
-    G = a.ParamDict['G']
-    thB_S = a.ParamDict['thB_S']
-    resol = a.ParamDict['resol']
-    phi = a.ConstDict['phi']
-    t_l = a.ParamDict['t_l']
-    z = a.ParamDict['z']
-    FH = a.ParamDict['FH']
-    FmH = a.ParamDict['FmH']
-    F0 = a.ParamDict['F0']
-    sp = a.ParamDict['sp']
-    dwp = a.ParamDict['dwp']
-    th = a.ParamDict['th']
-    spline_DW = a.splinenumber[1]
-    spline_strain = a.splinenumber[0]
-    param = a.ParamDict['par']
-
-    strain = f_strain(z, param[:len(sp):], t, spline_strain)
-    DW = f_DW(z, param[len(sp):len(sp)+len(dwp):], t, spline_DW)
-    thB = thB_S - strain * tan(thB_S)  # angle de Bragg dans chaque lamelle
+def _slice(res, eta, T):
+    """One step of the slice recurrence"""
+    sq = sqrt(eta*eta-1)
+    S1 = (res - eta + sq)*exp(-1j*T*sq)
+    S2 = (res - eta - sq)*exp(1j*T*sq)
+    return (eta + sq * ((S1+S2)/(S1-S2)))
 
-    eta = 0
-    res = 0
 
-    n = 1
-    while (n <= N):
-        g0 = sin(thB[n] - phi)  # gamma 0
-        gH = -sin(thB[n] + phi)  # gamma H
-        b = g0 / gH
-        T = pi * G * ((FH[n]*FmH[n])**0.5) * t_l * DW[n] / (wl * (abs(g0*gH)**0.5))
-        eta = (-b*(th-thB[n])*sin(2*thB_S) - 0.5*G*F0[n]*(1-b)) / ((abs(b)**0.5) * G * DW[n] * (FH[n]*FmH[n])**0.5)
-        S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-        S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-        res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-        n += 1
-    return convolve(abs(res)**2, resol, mode='same')
+# =============================================================================
+# Associative (Mobius) form of the slice recurrence
+# =============================================================================
+def f_Refl_fit_mobius(choice, Data, workers=1):
+    """
+    Same result as f_Refl_fit, but each slice is written as the 2x2 complex
+    matrix of the linear-fractional map res -> (A.res + B)/(C.res + D).
+    The matrices of all slices are built at once and multiplied with a
+    pairwise tree reduction, so there is no serial dependency on N.
+    With workers > 1 the stack is cut in contiguous chunks reduced in
+    parallel threads, the partial products being combined in order.
+    """
+    plan = Data[2]
+    if plan.L == 0:
+        return plan.res0 * ones(len(plan.th))
+    alpha, beta, T = plan.slices(Data[0], Data[1])
+
+    def reduce_chunk(sl):
+        M = _slice_matrix(alpha[sl, None]*plan.th + beta[sl, None],
+                          T[sl, None])
+        return _tree_product(M)
+
+    chunks = [slice(c[0], c[-1] + 1)
+              for c in array_split(arange(plan.L), max(1, int(workers)))
+              if len(c) > 0]
+    if len(chunks) > 1:
+        pool = ThreadPool(len(chunks))
+        try:
+            partial = pool.map(reduce_chunk, chunks)
+        finally:
+            pool.close()
+        partial = [[m[0] for m in M] for M in partial]
+        A, B, C, D = partial[0]
+        for M in partial[1:]:
+            A, B, C, D = _mat_mul(M, (A, B, C, D))
+    else:
+        A, B, C, D = [m[0] for m in reduce_chunk(chunks[0])]
+    res = plan.res0
+    return (A*res + B) / (C*res + D)
+
+
+def _slice_matrix(eta, T):
+    """
+    Coefficients (A, B, C, D) of the slice maps for (L x len(th)) arrays of
+    eta and (L x 1) reduced thicknesses.
+    With tau = -i.tan(T.sqrt(eta^2-1)) the recurrence of _slice reads
+    res' = ((eta.tau + sq).res - tau) / (tau.res + sq - eta.tau)
+    """
+    sq = sqrt(eta*eta-1)
+    tau = -1j*tan(T*sq)
+    return eta*tau + sq, -tau, tau, sq - eta*tau
+
+
+def _mat_mul(M2, M1):
+    """Product M2.M1 of two stacks of 2x2 matrices, rescaled per angle"""
+    A2, B2, C2, D2 = M2
+    A1, B1, C1, D1 = M1
+    A = A2*A1 + B2*C1
+    B = A2*B1 + B2*D1
+    C = C2*A1 + D2*C1
+    D = C2*B1 + D2*D1
+    # the map is projective, only the ratios matter: keep the entries O(1)
+    scale = maximum(maximum(abs(A), abs(B)), maximum(abs(C), abs(D)))
+    scale[scale == 0] = 1.
+    return A/scale, B/scale, C/scale, D/scale
+
+
+def _tree_product(M):
+    """
+    Ordered product M[L-1]...M[1].M[0] of a stack of slice matrices,
+    computed level by level by multiplying neighbouring pairs
+    """
+    while len(M[0]) > 1:
+        L = len(M[0])
+        even = tuple(m[0:L-1:2] for m in M)
+        odd = tuple(m[1:L:2] for m in M)
+        P = _mat_mul(odd, even)
+        if L % 2:
+            P = tuple(concatenate((p, m[-1:])) for p, m in zip(P, M))
+        M = P
+    return M
 
 
 # =============================================================================
-# label_3 = "Thick film"
+# Derivatives of the slice recurrence
 # =============================================================================
-def f_Refl_Thick_Film():
-    a = P4Rm()
-
-    wl = a.AllDataDict['wavelength']
-    t = a.AllDataDict['damaged_depth']
-    N = a.AllDataDict['number_slices']
-    t_film = a.AllDataDict['film_thick']
-
-    G = a.ParamDict['G']
-    thB_S = a.ParamDict['thB_S']
-    resol = a.ParamDict['resol']
-    phi = a.ConstDict['phi']
-    t_l = a.ParamDict['t_l']
-    z = a.ParamDict['z']
-    FH = a.ParamDict['FH']
-    FmH = a.ParamDict['FmH']
-    F0 = a.ParamDict['F0']
-    sp = a.ParamDict['sp']
-    dwp = a.ParamDict['dwp']
-    th = a.ParamDict['th']
-    spline_DW = a.splinenumber[1]
-    spline_strain = a.splinenumber[0]
-    param = a.ParamDict['par']
-    delta_t = t_film - t
-
-    strain = f_strain(z, param[:len(sp):], t, spline_strain)
-    DW = f_DW(z, param[len(sp):len(sp)+len(dwp):], t, spline_DW)
-    thB = thB_S - strain * tan(thB_S)  # angle de Bragg dans chaque lamelle
-
-    eta = 0
-    res = 0
-
-    g0 = sin(thB[0] - phi)  # gamma 0
-    gH = -sin(thB[0] + phi)  # gamma H
-    b = g0 / gH
-    T = pi * G * ((FH[0]*FmH[0])**0.5) * delta_t / (wl * (abs(g0*gH)**0.5))
-    eta = (-b*(th-thB[0])*sin(2*thB_S) - 0.5*G*F0[0]*(1-b)) / ((abs(b)**0.5) * G  * (FH[0]*FmH[0])**0.5)
-    S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-    S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-    res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-
-    n = 1
-    while (n <= N):
-        g0 = sin(thB[n] - phi)  # gamma 0
-        gH = -sin(thB[n] + phi)  # gamma H
-        b = g0 / gH
-        T = pi * G * ((FH[n]*FmH[n])**0.5) * t_l * DW[n] / (wl * (abs(g0*gH)**0.5))
-        eta = (-b*(th-thB[n])*sin(2*thB_S) - 0.5*G*F0[n]*(1-b)) / ((abs(b)**0.5) * G * DW[n] * (FH[n]*FmH[n])**0.5)
-        S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-        S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-        res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-        n += 1
-    return convolve(abs(res)**2, resol, mode='same')
+def f_Refl_fit_jac(choice, Data):
+    """
+    Amplitude of f_Refl_fit together with its derivatives with respect to
+    every value of the strain and DW profiles, returned as two
+    (N+1 x len(th)) arrays.
+    The per-layer partial derivatives are computed analytically in the
+    forward pass, then chained from the surface down to the substrate in a
+    single backward pass (the output is one complex number per angle).
+    """
+    strain = Data[0]
+    DW = Data[1]
+    plan = Data[2]
+    th = plan.th
+
+    terms, d_strain, d_DW = plan.slices_jac(strain, DW)
+    eta, T = _eta(terms, th), terms[2][:, None]
+    M = _slice_matrix(eta, T)
+    dM_strain = _slice_matrix_jac(eta, T, M, _eta(d_strain, th),
+                                  d_strain[2][:, None])
+    dM_DW = _slice_matrix_jac(eta, T, M, _eta(d_DW, th), d_DW[2][:, None])
+    A, B, C, D = M
+
+    L = plan.L
+    d_res = zeros((L, len(th)), dtype=complex)
+    d_s = zeros((L, len(th)), dtype=complex)
+    d_w = zeros((L, len(th)), dtype=complex)
+    res = plan.res0 * ones(len(th))
+    for j in range(L):
+        den = C[j]*res + D[j]
+        new = (A[j]*res + B[j]) / den
+        d_res[j] = (A[j]*D[j] - B[j]*C[j]) / (den*den)
+        dA, dB, dC, dD = dM_strain
+        d_s[j] = (dA[j]*res + dB[j] - new*(dC[j]*res + dD[j])) / den
+        dA, dB, dC, dD = dM_DW
+        d_w[j] = (dA[j]*res + dB[j] - new*(dC[j]*res + dD[j])) / den
+        res = new
+
+    jac_strain = zeros((len(strain), len(th)), dtype=complex)
+    jac_DW = zeros((len(DW), len(th)), dtype=complex)
+    index = plan.index
+    g = ones(len(th), dtype=complex)
+    for j in range(L-1, -1, -1):
+        jac_strain[index[j]] += g * d_s[j]
+        jac_DW[index[j]] += g * d_w[j]
+        g = g * d_res[j]
+    return res, jac_strain, jac_DW
+
+
+def _eta(terms, th):
+    """eta = alpha.th + beta as a (L x len(th)) array"""
+    return terms[0][:, None]*th + terms[1][:, None]
+
+
+def _slice_matrix_jac(eta, T, M, deta, dT):
+    """
+    Derivatives of the slice map coefficients M (see _slice_matrix) for
+    given derivatives of eta and of the reduced thickness
+    """
+    tau = M[2]
+    sq = M[0] - eta*tau
+    dsq = eta * deta / sq
+    dtau = -1j * (1 - tau*tau) * (dT*sq + T*dsq)
+    return (deta*tau + eta*dtau + dsq, -dtau, dtau,
+            dsq - deta*tau - eta*dtau)
 
 
 # =============================================================================
-# label_4 = "Thick film + substrate"
+# In-place evaluation with preallocated buffers
 # =============================================================================
-def f_Refl_Thick_Film_and_Substrate():
-    a = P4Rm()
-
-    wl = a.AllDataDict['wavelength']
-    t = a.AllDataDict['damaged_depth']
-    N = a.AllDataDict['number_slices']
-    t_film = a.AllDataDict['film_thick']
-    dw_film = a.AllDataDict['dw_thick']
-
-    G = a.ParamDict['G']
-    thB_S = a.ParamDict['thB_S']
-    resol = a.ParamDict['resol']
-    phi = a.ConstDict['phi']
-    t_l = a.ParamDict['t_l']
-    z = a.ParamDict['z']
-    FH = a.ParamDict['FH']
-    FmH = a.ParamDict['FmH']
-    F0 = a.ParamDict['F0']
-    sp = a.ParamDict['sp']
-    dwp = a.ParamDict['dwp']
-    th = a.ParamDict['th']
-    spline_DW = a.splinenumber[1]
-    spline_strain = a.splinenumber[0]
-    param = a.ParamDict['par']
-    b_Sub = a.ParamDict['b_S_s']
-    thB_Sub = a.ParamDict['thB_S_s']
-    G_Sub = a.ParamDict['G_s']
-    F0_Sub = a.ParamDict['F0_s']
-    FH_Sub = a.ParamDict['FH_s']
-    FmH_Sub = a.ParamDict['FmH_s']
-    delta_t = t_film - t
-
-    strain = f_strain(z, param[:len(sp):], t, spline_strain)
-    DW = f_DW(z, param[len(sp):len(sp)+len(dwp):], t, spline_DW)
-    thB = thB_S - strain * tan(thB_S)  # angle de Bragg dans chaque lamelle
-
-    temp1 = -b_Sub*(th-thB_Sub)*sin(2*thB_Sub) - (0.5*G_Sub*F0_Sub[0]*(1-b_Sub))
-    temp2 = (abs(b_Sub)**0.5) * G_Sub * (FH_Sub[0]*FmH_Sub[0])**0.5
-    eta = temp1/temp2
-    res = (eta - signe(eta.real)*((eta*eta - 1)**0.5))
-
-    g0 = sin(thB[0] - phi)  # gamma 0
-    gH = -sin(thB[0] + phi)  # gamma H
-    b = g0 / gH
-    T = pi * G * ((FH[0]*FmH[0])**0.5) * delta_t * dw_film / (wl * (abs(g0*gH)**0.5))
-    eta = (-b*(th-thB[0])*sin(2*thB_S) - 0.5*G*F0[0]*(1-b)) / ((abs(b)**0.5) * G  * dw_film * (FH[0]*FmH[0])**0.5)
-    S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-    S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-    res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-
-    n = 1
-    while (n <= N):
-        g0 = sin(thB[n] - phi)  # gamma 0
-        gH = -sin(thB[n] + phi)  # gamma H
-        b = g0 / gH
-        T = pi * G * ((FH[n]*FmH[n])**0.5) * t_l * DW[n] * dw_film / (wl * (abs(g0*gH)**0.5))
-        eta = (-b*(th-thB[n])*sin(2*thB_S) - 0.5*G*F0[n]*(1-b)) / ((abs(b)**0.5) * G * DW[n] * dw_film * (FH[n]*FmH[n])**0.5)
-        S1 = (res - eta + (eta*eta-1)**0.5)*exp(-1j*T*(eta*eta-1)**0.5)
-        S2 = (res - eta - (eta*eta-1)**0.5)*exp(1j*T*(eta*eta-1)**0.5)
-        res = (eta + ((eta*eta-1)**0.5) * ((S1+S2)/(S1-S2)))
-        n += 1
-    return convolve(abs(res)**2, resol, mode='same')
+class Refl_workspace():
+    """
+    Drop-in replacement for f_Refl_fit which owns the complex work arrays
+    of the slice recurrence. The buffers are allocated on the first call
+    (or when the angle grid changes) and every step writes into them with
+    out= ufuncs, so the slice loop itself does not allocate; one instance
+    is kept for the whole fit.
+    """
+    def __init__(self):
+        self.shape = None
+
+    def allocate(self, shape):
+        self.shape = shape
+        self.res = zeros(shape, dtype=complex)
+        self.eta = zeros(shape, dtype=complex)
+        self.sq = zeros(shape, dtype=complex)
+        self.e = zeros(shape, dtype=complex)
+        self.S1 = zeros(shape, dtype=complex)
+        self.S2 = zeros(shape, dtype=complex)
+
+    def __call__(self, choice, Data):
+        plan = Data[2]
+        alpha, beta, T = plan.slices(Data[0], Data[1])
+        shape = alpha.shape[:-1] + plan.th.shape
+        if shape != self.shape:
+            self.allocate(shape)
+        res = self.res
+        res[...] = plan.res0
+        mT = -1j*T
+        for j in range(plan.L):
+            self.step(res, plan.th, alpha[..., j, None], beta[..., j, None],
+                      mT[..., j, None], res)
+        return res.copy()
+
+    def step(self, res, th, alpha, beta, mT, out):
+        """
+        One step of the slice recurrence (see _slice) written in out, with
+        mT = -i.T the reduced thickness of the layer
+        """
+        eta, sq, e, S1, S2 = self.eta, self.sq, self.e, self.S1, self.S2
+        multiply(th, alpha, out=eta)
+        add(eta, beta, out=eta)
+        multiply(eta, eta, out=sq)
+        subtract(sq, 1, out=sq)
+        np_sqrt(sq, out=sq)
+        multiply(sq, mT, out=e)
+        np_exp(e, out=e)
+        # S1 = (res - eta + sq).exp(-iT.sq), S2 = (res - eta - sq)/exp(-iT.sq)
+        subtract(res, eta, out=S1)
+        subtract(S1, sq, out=S2)
+        add(S1, sq, out=S1)
+        multiply(S1, e, out=S1)
+        divide(S2, e, out=S2)
+        # out = eta + sq.(S1 + S2)/(S1 - S2)
+        add(S1, S2, out=e)
+        subtract(S1, S2, out=S1)
+        divide(e, S1, out=e)
+        multiply(e, sq, out=e)
+        add(e, eta, out=out)
 
 
 # =============================================================================
-# Only substrate for t=0 --> damaged depth
+# Prefix-state cache for incremental re-evaluation
 # =============================================================================
-def f_Refl_Substrate():
-    a = P4Rm()
-
-    G = a.ParamDict['G']
-    thB_S = a.ParamDict['thB_S']
-    resol = a.ParamDict['resol']
-    b_S = a.ParamDict['b_S']
-    FH = a.ParamDict['FH']
-    FmH = a.ParamDict['FmH']
-    F0 = a.ParamDict['F0']
-    th = a.ParamDict['th']
-
-    eta = (-b_S*(th-thB_S)*sin(2*thB_S) - 0.5*G*F0[0]*(1-b_S)) / ((abs(b_S)**0.5) * G * (FH[0]*FmH[0])**0.5)
-    res = (eta - signe(eta.real)*((eta*eta - 1)**0.5)) * (FH[0] / FmH[0])**0.5
-    return convolve(abs(res)**2, resol, mode='same')
+class Refl_cache(Refl_workspace):
+    """
+    Drop-in replacement for f_Refl_fit which keeps the amplitude reached
+    after every layer of the last evaluation. The recurrence goes from the
+    substrate to the surface, so when only the end of the strain/DW
+    profiles has changed (finite-difference Jacobian columns on local
+    B-spline coefficients) the evaluation restarts from the first layer
+    whose Bragg angle or DW factor differs, instead of from the bottom.
+    The cache is invalidated when the simulation plan changes.
+    """
+    def __init__(self):
+        Refl_workspace.__init__(self)
+        self.reset()
+
+    def reset(self):
+        self.plan = None
+        self.strain = None
+        self.DW = None
+        self.states = None
+
+    def __call__(self, choice, Data):
+        plan = Data[2]
+        strain = Data[0][plan.index]
+        DW = Data[1][plan.index]
+        th = plan.th
+
+        start = self.first_changed_layer(plan, strain, DW)
+        if start is None:
+            return self.states[-1].copy()
+        if start == 0:
+            if (self.states is None or self.shape != th.shape or
+                    len(self.states) != plan.L + 1):
+                self.allocate(th.shape)
+                self.states = zeros((plan.L + 1, len(th)), dtype=complex)
+            self.states[0] = plan.res0
+        self.plan = plan
+        self.strain = strain
+        self.DW = DW
+
+        alpha, beta, T = plan.slices(Data[0], Data[1])
+        mT = -1j*T
+        for j in range(start, plan.L):
+            self.step(self.states[j], th, alpha[j], beta[j], mT[j],
+                      self.states[j + 1])
+        return self.states[-1].copy()
+
+    def first_changed_layer(self, plan, strain, DW):
+        """
+        Index of the first layer to recompute, 0 for a full evaluation and
+        None when the layers are identical to the cached ones
+        """
+        if self.states is None or plan is not self.plan:
+            return 0
+        index = ((strain != self.strain) | (DW != self.DW)).nonzero()[0]
+        if len(index) == 0:
+            return None
+        return index[0]
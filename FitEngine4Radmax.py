@@ -0,0 +1,820 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: A_BOULLE & M_SOUILAH
+# Radmax project
+
+# =============================================================================
+# Fitting engine, independent of the GUI
+# =============================================================================
+
+import os
+import pickle
+from multiprocessing import cpu_count, Event, Pool
+from scipy.optimize import least_squares
+from time import time
+
+import numpy as np
+from numpy import (array, asarray, broadcast_to, concatenate, exp, log10,
+                   nonzero, zeros)
+from numpy.random import SeedSequence, default_rng
+
+import Parameters4Radmax as p4R
+from Def_XRD4Radmax import (f_Refl_fit_mobius, Refl_cache, Refl_workspace,
+                            f_Refl_fit_jac, f_plan)
+from Numba4Radmax import Refl_numba, numba_install
+from GSA4Radmax import (gsa, gsa_limits, gsa_temperature, Gsa_state,
+                        STOP_ABORTED)
+from Def_Strain4Radmax import f_strain, f_strain_jac
+from Def_DW4Radmax import f_DW, f_DW_jac
+
+import logging
+logger = logging.getLogger(__name__)
+
+FIT_GSA = 0
+FIT_LEASTSQ = 1
+FIT_LMFIT = 2
+
+# cycles run by the annealing chains between two reports to the caller
+chain_step = 50
+
+# profile function of the lmfit parameters for each model (see f_strain and
+# f_DW); the model number is the same profile taking the coefficients as an
+# array, used for the Jacobian
+lmfit_splines = {0: 5, 1: 6, 2: 4, 3: 7}
+
+
+class Fit_checkpoint():
+    """
+    Checkpoints of a running fit written to the file path, at most once
+    every period seconds except the last one: fit type, number of
+    parameters and state of the minimizer (a dict), enough to resume the
+    fit with Fit_engine.run
+    """
+    def __init__(self, path, period=None):
+        if period is None:
+            period = p4R.checkpoint_period
+        self.path = path
+        self.period = period
+        self.last = time()
+
+    def save(self, fit_type, nb_par, state, force=False):
+        if not force and time() - self.last < self.period:
+            return
+        save_checkpoint(self.path, {'fit_type': fit_type, 'nb_par': nb_par,
+                                    'state': state})
+        self.last = time()
+
+
+def save_checkpoint(path, checkpoint):
+    """Write checkpoint to path, never leaving a truncated file behind"""
+    with open(path + ".tmp", 'wb') as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    """Checkpoint written by Fit_checkpoint"""
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def ignore(*args):
+    pass
+
+
+def never():
+    return False
+
+
+class Fit_model():
+    """
+    Experiment and model of a fit, with no reference to the GUI:
+    th, Iobs: angles and observed intensity,
+    plan: simulation plan of the sample (see Plan4Radmax),
+    resol_conv: convolution with the instrumental resolution,
+    z: depth of the profile slices,
+    sp, dwp, state_sp, state_dwp: starting strain and DW coefficients and
+    flags of the coefficients to fit,
+    spline: (strain, DW) profile functions (see f_strain and f_DW),
+    data: fit settings, with the keys of P4Rm.AllDataDict used by the fit
+    (geometry, model, damaged_depth, background, bounds, GSA and leastsq
+    options),
+    jump_scale: GSA jump scale, xrd_engine: see p4R.XRD_engine_choice,
+    nb_chains, exchange: number of GSA chains and cycles between two
+    exchanges of their states (see Fit_engine.run_gsa_chains),
+    nb_moves, pick: GSA moves scored together at each cycle and the one
+    submitted to the acceptance test (see GSA4Radmax.gsa),
+    stopping: early stopping of GSA (GSA4Radmax.Stop_criteria, None to run
+    all the cycles).
+    """
+    def __init__(self, th, Iobs, plan, resol_conv, z, sp, dwp, state_sp,
+                 state_dwp, spline, data, jump_scale, xrd_engine=0,
+                 nb_chains=1, exchange=0, nb_moves=1, pick='best',
+                 stopping=None):
+        self.th = asarray(th)
+        self.Iobs = asarray(Iobs)
+        self.plan = plan
+        self.resol_conv = resol_conv
+        self.z = z
+        self.sp = array(sp, dtype=float)
+        self.dwp = array(dwp, dtype=float)
+        self.state_sp = asarray(state_sp, dtype=bool)
+        self.state_dwp = asarray(state_dwp, dtype=bool)
+        self.spline = spline
+        self.data = dict(data)
+        self.jump_scale = jump_scale
+        self.xrd_engine = xrd_engine
+        self.nb_chains = nb_chains
+        self.exchange = exchange
+        self.nb_moves = nb_moves
+        self.pick = pick
+        self.stopping = stopping
+
+    @property
+    def par(self):
+        return concatenate((self.sp, self.dwp))
+
+    @property
+    def state(self):
+        return concatenate((self.state_sp, self.state_dwp))
+
+
+def fit_model(project):
+    """Fit_model of a project (see Parameters4Radmax.Project)"""
+    a = project
+    chains = p4R.gsa_chains(a.AllDataDict)
+    return Fit_model(a.ParamDict['th'], a.ParamDict['Iobs'],
+                     f_plan(a.AllDataDict['geometry'], project),
+                     a.ParamDict['resol_conv'], a.ParamDict['z'],
+                     a.ParamDict['sp'], a.ParamDict['dwp'],
+                     a.ParamDict['state_sp'], a.ParamDict['state_dwp'],
+                     a.splinenumber, a.AllDataDict,
+                     a.ConstDict['jump_scale'], a.xrd_engine,
+                     chains['nb_chains'], chains['exchange'],
+                     chains['nb_moves'], chains['pick'], a.stopping)
+
+
+class Par_map():
+    """
+    Vector of the optimizers made of the free coefficients of par only
+    (free: flags of the coefficients to fit), the frozen coefficients
+    keeping their value in the full vectors
+    """
+    def __init__(self, par, free):
+        self.par = array(par, dtype=float)
+        self.free = nonzero(free)[0]
+
+    def pack(self, p):
+        """Free coefficients of the full vector(s) p"""
+        return asarray(p)[..., self.free]
+
+    def unpack(self, x):
+        """Full vector(s) of the free coefficients x"""
+        x = asarray(x)
+        p = broadcast_to(self.par, x.shape[:-1] + self.par.shape).copy()
+        p[..., self.free] = x
+        return p
+
+    def index(self, i):
+        """Index in par of the free coefficient i (-1 for none)"""
+        return self.free[i] if i >= 0 else -1
+
+
+class Fit_result():
+    """
+    Outcome of a fit: best parameters par (strain then DW coefficients),
+    sp and dwp, their simulated intensity y_cal and residual error, the
+    success flag of the minimizer, whether the fit was aborted and the
+    minimizer output (lmfit MinimizerResult or least_squares
+    OptimizeResult), the reason GSA stopped before its last cycle (see
+    GSA4Radmax.Stop_criteria), the statistics of every GSA chain when
+    several were run and, for the bounded leastsq fit, the indices in par
+    of the coefficients ending on one of their bounds
+    """
+    def __init__(self, par, len_sp, y_cal, residual_error, success,
+                 aborted=False, output=None, stop_reason=None):
+        self.par = asarray(par)
+        self.sp = self.par[:len_sp]
+        self.dwp = self.par[len_sp:]
+        self.y_cal = y_cal
+        self.residual_error = residual_error
+        self.success = success
+        self.aborted = aborted
+        self.output = output
+        self.stop_reason = stop_reason
+        self.chains = None
+        self.bounded = False
+        self.at_bounds = []
+
+
+def lmfit_parameters(model):
+    """
+    lmfit Parameters of the model and names of the coefficients, in the
+    order of par
+    """
+    from lmfit import Parameters
+    data = model.data
+    sp = model.sp
+    dwp = model.dwp
+    fit_params = Parameters()
+    if data['model'] == 2:
+        fit_params.add('heigt_strain', value=sp[0],
+                       min=data['strain_height_min'],
+                       max=data['strain_height_max'],
+                       vary=model.state_sp[0])
+        fit_params.add('loc_strain', value=sp[1], min=0., max=1.,
+                       vary=model.state_sp[1])
+        fit_params.add('fwhm_1_strain', value=sp[2], min=0., max=1.,
+                       vary=model.state_sp[2])
+        fit_params.add('fwhm_2_strain', value=sp[3], min=0., max=1.,
+                       vary=model.state_sp[3])
+        fit_params.add('strain_eta_1', value=sp[4],
+                       min=data['strain_eta_min'],
+                       max=data['strain_eta_max'],
+                       vary=model.state_sp[4])
+        fit_params.add('strain_eta_2', value=sp[5],
+                       min=data['strain_eta_min'],
+                       max=data['strain_eta_max'],
+                       vary=model.state_sp[5])
+        fit_params.add('bkg_strain', value=sp[6],
+                       min=data['strain_bkg_min'],
+                       max=data['strain_bkg_max'],
+                       vary=model.state_sp[6])
+
+        fit_params.add('heigt_dw', value=dwp[0],
+                       min=data['dw_height_min'],
+                       max=data['dw_height_max'],
+                       vary=model.state_sp[0])
+        fit_params.add('loc_dw', value=dwp[1], min=0., max=1.,
+                       vary=model.state_dwp[1])
+        fit_params.add('fwhm_1_dw', value=dwp[2], min=0., max=1.,
+                       vary=model.state_dwp[2])
+        fit_params.add('fwhm_2_dw', value=dwp[3], min=0., max=1.,
+                       vary=model.state_dwp[3])
+        fit_params.add('dw_eta_1', value=dwp[4],
+                       min=data['dw_eta_min'],
+                       max=data['dw_eta_max'],
+                       vary=model.state_dwp[4])
+        fit_params.add('dw_eta_2', value=dwp[5],
+                       min=data['dw_eta_min'],
+                       max=data['dw_eta_max'],
+                       vary=model.state_dwp[5])
+        fit_params.add('bkg_dw', value=dwp[6],
+                       min=data['dw_bkg_min'],
+                       max=data['dw_bkg_max'],
+                       vary=model.state_dwp[6])
+        return fit_params, list(p4R.asym_pv_list)
+    names = []
+    for ii in range(len(sp)):
+        name = 'sp_' + str(ii)
+        fit_params.add(name, value=sp[ii], min=data['strain_min'],
+                       max=data['strain_max'], vary=model.state_sp[ii])
+        names.append(name)
+    fit_params.add('nb_sp_val', value=len(sp), vary=False)
+    for jj in range(len(dwp)):
+        name = 'dwp_' + str(jj)
+        fit_params.add(name, value=dwp[jj], min=data['dw_min'],
+                       max=data['dw_max'], vary=model.state_dwp[jj])
+        names.append(name)
+    fit_params.add('nb_dwp_val', value=len(dwp), vary=False)
+    return fit_params, names
+
+
+def leastsq_bounds(model):
+    """
+    Bounds (lower, upper) of the coefficients of par in the leastsq fit of
+    a Fit_model: the GSA limits, the coefficients whose two limits are
+    equal (no limits are set for the histogram model) being unbounded
+    """
+    limits = gsa_limits(model.data, len(model.sp), len(model.dwp))
+    lower, upper = limits[0::2].copy(), limits[1::2].copy()
+    unbounded = lower == upper
+    lower[unbounded] = -np.inf
+    upper[unbounded] = np.inf
+    return lower, upper
+
+
+def out_of_bounds(model, par=None):
+    """
+    Indices of the free coefficients of par (default: the starting ones)
+    out of the leastsq bounds of a Fit_model
+    """
+    if par is None:
+        par = model.par
+    par = asarray(par)
+    lower, upper = leastsq_bounds(model)
+    return nonzero(model.state & ((par < lower) | (par > upper)))[0]
+
+
+class Fit_engine():
+    """
+    GSA, leastsq and lmfit fits of a Fit_model.
+    The callbacks report the progress of the fit:
+    progress(y_cal, data, deformation) with data = [E_min, nb_minima] for
+    GSA (None otherwise) and deformation = [parameters],
+    limit_exceeded(index) when a GSA jump leaves the bounds (-1 when it
+    does not), count_cycle(iteration) at each GSA cycle.
+    stop() may be called from another thread to interrupt the fit.
+    GSA and leastsq fits save their state in checkpoint (Fit_checkpoint)
+    when given one.
+    The leastsq fit starting out of its bounds (see out_of_bounds) raises
+    a ValueError, unless move_to_bounds, the starting values being then
+    moved onto the bounds.
+    """
+    def __init__(self, model, progress=ignore, limit_exceeded=ignore,
+                 count_cycle=ignore, fit_type=FIT_GSA, checkpoint=None,
+                 move_to_bounds=False):
+        self.model = model
+        self.checkpoint = checkpoint
+        self.move_to_bounds = move_to_bounds
+        # the GSA and leastsq vectors hold the free coefficients only
+        self.par_map = Par_map(model.par, model.state)
+        self.progress = progress
+        self.limit_exceeded = limit_exceeded
+        self.count_cycle = count_cycle
+        self.need_abort = 0
+        self.len_sp = len(model.sp)
+        self.len_dwp = len(model.dwp)
+        self.lmfit_names = []
+        self.y_cal = None
+        self.y_cal_batch = None
+        self.p_best = None
+        self.E_best = np.inf
+        # set by stop() to interrupt the GSA chains of the worker processes
+        self.chain_abort = None
+        # work arrays of the (K x len(th)) recurrences of residual_batch
+        self.batch_engine = Refl_workspace()
+        self.engine = self.reflectivity_engine(fit_type)
+
+    def reflectivity_engine(self, fit_type):
+        xrd_engine = self.model.xrd_engine
+        if xrd_engine == 2 and not numba_install:
+            logger.log(logging.WARNING, "Numba is not installed, " +
+                       "the NumPy engine is used instead")
+        if xrd_engine == 2 and numba_install:
+            return Refl_numba()
+        elif xrd_engine == 1:
+            def engine(choice, Data):
+                return f_Refl_fit_mobius(choice, Data, cpu_count())
+            return engine
+        elif fit_type == FIT_LEASTSQ or fit_type == FIT_LMFIT:
+            # leastsq/lmfit perturb one coefficient per Jacobian column:
+            # restart the recurrence from the first modified slice
+            return Refl_cache()
+        # the work arrays of the recurrence are reused for the whole fit
+        return Refl_workspace()
+
+    def stop(self):
+        self.need_abort = 1
+        if self.chain_abort is not None:
+            self.chain_abort.set()
+
+    def aborted(self):
+        return self.need_abort == 1
+
+    # -------------------------------------------------------------------------
+    def profiles(self, p, spline=None):
+        """Strain and DW profiles of the parameters p"""
+        m = self.model
+        if spline is None:
+            spline = m.spline
+        t = m.data['damaged_depth']
+        strain = f_strain(m.z, p[:self.len_sp:], t, spline[0])
+        DW = f_DW(m.z, p[self.len_sp:self.len_sp + self.len_dwp:], t,
+                  spline[1])
+        return strain, DW
+
+    def lmfit_profiles(self, pars):
+        """Strain and DW profiles of lmfit parameters"""
+        m = self.model
+        vals = pars.valuesdict()
+        const = []
+        spline = lmfit_splines[int(m.data['model'])]
+        if m.data['model'] == 2:
+            for name in p4R.asym_pv_list:
+                const.append(vals[name])
+        else:
+            len_sp = int(vals['nb_sp_val'])
+            len_dwp = int(vals['nb_dwp_val'])
+            const.append(len_sp)
+            const.append(len_dwp)
+            for ii in range(len_sp):
+                const.append(vals['sp_' + str(ii)])
+            for ii in range(len_dwp):
+                const.append(vals['dwp_' + str(ii)])
+        const = np.asarray(const, dtype=np.float64)
+        t = m.data['damaged_depth']
+        return f_strain(m.z, const, t, spline), f_DW(m.z, const, t, spline)
+
+    def simulate(self, strain, DW):
+        """Normalized intensity of the strain and DW profiles"""
+        m = self.model
+        res = self.engine(m.data['geometry'], [strain, DW, m.plan])
+        y_cal = m.resol_conv(abs(res) ** 2)
+        self.y_cal = y_cal / y_cal.max() + m.data['background']
+        return self.y_cal
+
+    def residual(self, p):
+        """log10 residual of the parameters p"""
+        y_cal = self.simulate(*self.profiles(p))
+        return log10(self.model.Iobs) - log10(y_cal)
+
+    def residual_square(self, p):
+        """GSA energy of the parameters p"""
+        r = self.residual(p)
+        return (r ** 2).sum() / len(r)
+
+    def energy(self, x):
+        """GSA energy of the free coefficients x"""
+        return self.residual_square(self.par_map.unpack(x))
+
+    def energy_batch(self, X):
+        """GSA energies of the free coefficients stacked in X"""
+        return self.residual_square_batch(self.par_map.unpack(X))
+
+    def on_limit_exceeded(self, i):
+        self.limit_exceeded(self.par_map.index(i))
+
+    def residual_leastsq(self, x, y, th):
+        p = self.par_map.unpack(x)
+        r = self.residual(p)
+        self.progress(self.y_cal, None, [array(p)])
+        E = (r ** 2).sum() / len(r)
+        if self.need_abort == 0 and E < self.E_best:
+            self.p_best, self.E_best = array(p), E
+            self.save_checkpoint(FIT_LEASTSQ, {'par': self.p_best,
+                                               'E': E})
+        if self.need_abort == 1:
+            return zeros(len(r))
+        return r
+
+    def residual_lmfit(self, pars, x, y):
+        y_cal = self.simulate(*self.lmfit_profiles(pars))
+        return (log10(y) - log10(y_cal))
+
+    def per_iteration(self, pars, iter, resid, *args, **kws):
+        if self.need_abort == 1:
+            return True
+        if iter < 3 or iter % 10 == 0:
+            p = [pars[name].value for name in self.lmfit_names]
+            self.progress(self.y_cal, None, [p])
+
+    def jacobian(self, p, spline_strain, spline_DW, free=None):
+        """
+        Analytic Jacobian of the log10 residual with respect to the full
+        (sp, dwp) vector p, or to its coefficients free only: derivatives
+        of the slice recurrence, chained through the strain/DW profiles,
+        the resolution convolution, the max-normalization and the log10.
+        """
+        m = self.model
+        z = m.z
+        t = m.data['damaged_depth']
+        sp = p[:self.len_sp:]
+        dwp = p[self.len_sp:self.len_sp + self.len_dwp:]
+        strain = f_strain(z, sp, t, spline_strain)
+        DW = f_DW(z, dwp, t, spline_DW)
+        res, d_strain, d_DW = f_Refl_fit_jac(m.data['geometry'],
+                                             [strain, DW, m.plan])
+        jac_sp = f_strain_jac(z, sp, t, spline_strain)
+        jac_dwp = f_DW_jac(z, dwp, t, spline_DW)
+        if free is not None:
+            jac_sp = jac_sp[:, free[free < self.len_sp]]
+            jac_dwp = jac_dwp[:, free[free >= self.len_sp] - self.len_sp]
+        d_res = np.hstack((d_strain.T.dot(jac_sp), d_DW.T.dot(jac_dwp)))
+        I = m.resol_conv(abs(res) ** 2)
+        d_I = 2 * (res.conj()[:, None] * d_res).real
+        d_I = m.resol_conv(d_I.T).T
+        k = I.argmax()
+        y_cal = I / I[k] + m.data['background']
+        d_y = d_I / I[k] - I[:, None] * d_I[k] / I[k] ** 2
+        return -d_y / (y_cal[:, None] * np.log(10.))
+
+    def jacobian_leastsq(self, x, y, th):
+        if self.need_abort == 1:
+            return np.zeros((len(y), len(x)))
+        return self.jacobian(self.par_map.unpack(x), self.model.spline[0],
+                             self.model.spline[1], self.par_map.free)
+
+    def jacobian_lmfit(self, pars, x, y):
+        """Jacobian restricted to the varying lmfit parameters"""
+        names = self.lmfit_names
+        p = array([pars[name].value for name in names])
+        var = [names.index(name) for name, par in pars.items()
+               if par.vary and name in names]
+        if self.need_abort == 1:
+            return np.zeros((len(y), len(var)))
+        model = int(self.model.data['model'])
+        return self.jacobian(p, model, model)[:, var]
+
+    def residual_batch(self, P):
+        """
+        log10 residuals of the K parameter vectors stacked in the rows of P,
+        computed with a single call to the batched reflectivity engine
+        """
+        m = self.model
+        P = np.atleast_2d(P)
+        profiles = [self.profiles(p) for p in P]
+        strain = array([s for s, _ in profiles])
+        DW = array([d for _, d in profiles])
+        res = self.batch_engine(m.data['geometry'], [strain, DW, m.plan])
+        y_cal = m.resol_conv(abs(res) ** 2)
+        self.y_cal_batch = (y_cal / y_cal.max(axis=1)[:, None] +
+                            m.data['background'])
+        return log10(m.Iobs) - log10(self.y_cal_batch)
+
+    def residual_square_batch(self, P):
+        """
+        GSA energies of the K parameter vectors stacked in P, y_cal being
+        the intensity of the best of them
+        """
+        r = self.residual_batch(P)
+        E = (r ** 2).sum(axis=1) / r.shape[1]
+        self.y_cal = self.y_cal_batch[E.argmin()]
+        return E
+
+    # -------------------------------------------------------------------------
+    def result(self, par, success, output=None):
+        r = self.residual(asarray(par))
+        return Fit_result(par, self.len_sp, self.y_cal,
+                          (r ** 2).sum() / len(r), success,
+                          self.need_abort == 1, output)
+
+    def save_checkpoint(self, fit_type, state, force=False):
+        if self.checkpoint is not None:
+            state = dict(state, free=self.par_map.free)
+            self.checkpoint.save(fit_type, len(self.model.par), state, force)
+
+    def resume_state(self, resume, fit_type):
+        """State of the minimizer saved in the checkpoint resume"""
+        if resume['fit_type'] != fit_type:
+            raise ValueError("The checkpoint is not a " +
+                             p4R.FitAlgo_choice[fit_type] + " fit")
+        if (resume['nb_par'] != len(self.model.par) or not
+                np.array_equal(resume['state']['free'], self.par_map.free)):
+            raise ValueError("The checkpoint is not a fit of this model")
+        return resume['state']
+
+    def gsa_moves(self):
+        """Options of gsa for the moves and stopping of the model"""
+        m = self.model
+        return {'energy_batch': self.energy_batch,
+                'nb_moves': m.nb_moves, 'pick': m.pick,
+                'stopping': m.stopping}
+
+    def gsa_bounds(self):
+        """Jump scales and limits of the free coefficients for gsa"""
+        m = self.model
+        free = self.par_map.free
+        par_scale = zeros(len(free)) + m.jump_scale
+        par_limits = gsa_limits(m.data, self.len_sp, self.len_dwp)
+        return par_scale, par_limits.reshape(-1, 2)[free].ravel()
+
+    def run_gsa(self, resume=None):
+        """
+        GSA fit, run by segments of chain_step cycles with a checkpoint
+        after each one; resume (a checkpoint) carries on with a previous
+        fit, stopped by the user or not, as if it had not been stopped.
+        """
+        m = self.model
+        if m.nb_chains > 1:
+            return self.run_gsa_chains(m.nb_chains, m.exchange,
+                                       resume=resume)
+        par_scale, par_limits = self.gsa_bounds()
+        if resume is None:
+            x = self.par_map.pack(m.par)
+            state = Gsa_state(x, self.energy(x), m.data['qa'])
+        else:
+            state = self.resume_state(resume, FIT_GSA)['states'][0]
+            if state.stop_reason == STOP_ABORTED:
+                state.stop_reason = None
+        nb_cycle = int(m.data['nb_cycle_max'])
+
+        def on_trial(fp_t, E_min, nb_minima):
+            self.progress(self.y_cal, [E_min, nb_minima],
+                          [self.par_map.unpack(fp_t)])
+        while state.iteration < nb_cycle and state.stop_reason is None:
+            state = gsa(self.energy, None, par_scale, par_limits,
+                        m.data, self.on_limit_exceeded, self.count_cycle,
+                        on_trial, self.aborted, state=state,
+                        last_cycle=min(state.iteration + chain_step,
+                                       nb_cycle),
+                        **self.gsa_moves())
+            self.save_checkpoint(FIT_GSA, {'states': [state]})
+        self.save_checkpoint(FIT_GSA, {'states': [state]}, True)
+        result = self.result(self.par_map.unpack(state.fp_min), True)
+        result.stop_reason = state.stop_reason
+        return result
+
+    def run_gsa_chains(self, nb_chains, exchange=0, t_ratio=2.,
+                       processes=None, seed=None, resume=None):
+        """
+        nb_chains GSA chains run in a pool of processes, each process
+        receiving the model once.
+        With exchange = 0 the chains are independent; otherwise chain c
+        anneals from tmax*t_ratio**c and, every exchange cycles, the
+        current states of neighbouring chains are swapped with the
+        parallel tempering criterion.
+        The run ends when every chain has met the stopping criteria.
+        The chains check the stopping criteria and stop() at each cycle.
+        A checkpoint is saved after each segment, resume carries on with
+        the chains of a checkpoint.
+        Returns the Fit_result of the best point found by all the chains,
+        result.chains giving the statistics of each chain.
+        """
+        m = self.model
+        if resume is None:
+            seeds = SeedSequence(seed).spawn(nb_chains + 1)
+            swap_rng = default_rng(seeds[-1])
+            x = self.par_map.pack(m.par)
+            E = self.energy(x)
+            states = [Gsa_state(x, E, m.data['qa'], default_rng(sq))
+                      for sq in seeds[:-1]]
+            nb_swaps = zeros(nb_chains, dtype=int)
+            cycle = 0
+        else:
+            saved = self.resume_state(resume, FIT_GSA)
+            if len(saved['states']) != nb_chains:
+                raise ValueError("The checkpoint is not a fit of " +
+                                 str(nb_chains) + " chains")
+            states, swap_rng = saved['states'], saved['swap_rng']
+            nb_swaps, cycle = saved['nb_swaps'], saved['cycle']
+            for state in states:
+                if state.stop_reason == STOP_ABORTED:
+                    state.stop_reason = None
+        datas = []
+        for c in range(nb_chains):
+            data = dict(m.data)
+            if exchange > 0:
+                data['tmax'] = m.data['tmax'] * t_ratio**c
+            datas.append(data)
+        temperatures = [gsa_temperature(data) for data in datas]
+        nb_cycle = int(m.data['nb_cycle_max'])
+        step = exchange if exchange > 0 else chain_step
+        if processes is None:
+            processes = min(nb_chains, cpu_count())
+
+        def checkpoint():
+            return {'states': states, 'swap_rng': swap_rng,
+                    'nb_swaps': nb_swaps, 'cycle': cycle}
+        self.chain_abort = Event()
+        if self.aborted():
+            self.chain_abort.set()
+        pool = Pool(processes, initializer=chain_init,
+                    initargs=(m, self.chain_abort))
+        try:
+            while (cycle < nb_cycle and not self.aborted() and
+                   not all(state.stop_reason for state in states)):
+                last_cycle = min(cycle + step, nb_cycle)
+                states = pool.map(chain_segment,
+                                  [(data, state, last_cycle)
+                                   for data, state in zip(datas, states)])
+                if self.aborted():
+                    # the segment is unfinished: checkpoint the chains at
+                    # the cycle they reached, to be resumed before the swap
+                    break
+                cycle = last_cycle
+                if exchange > 0:
+                    for c in range(nb_chains - 1):
+                        s1, s2 = states[c], states[c+1]
+                        T1 = temperatures[c][cycle-1]
+                        T2 = temperatures[c+1][cycle-1]
+                        delta = (1./T1 - 1./T2) * (s1.E_0 - s2.E_0)
+                        if delta >= 0 or swap_rng.random() < exp(delta):
+                            s1.fp_0, s2.fp_0 = s2.fp_0, s1.fp_0
+                            s1.E_0, s2.E_0 = s2.E_0, s1.E_0
+                            nb_swaps[c:c+2] += 1
+                best = min(states, key=lambda state: state.E_min)
+                self.count_cycle(cycle)
+                fp_min = self.par_map.unpack(best.fp_min)
+                self.residual_square(fp_min)
+                self.progress(self.y_cal,
+                              [best.E_min,
+                               sum(state.nb_minima for state in states)],
+                              [fp_min])
+                self.save_checkpoint(FIT_GSA, checkpoint())
+        finally:
+            pool.close()
+            pool.join()
+            self.chain_abort = None
+
+        self.save_checkpoint(FIT_GSA, checkpoint(), True)
+        best = min(states, key=lambda state: state.E_min)
+        result = self.result(self.par_map.unpack(best.fp_min), True)
+        result.chains = [{'tmax': data['tmax'], 'E_min': state.E_min,
+                          'nb_minima': state.nb_minima,
+                          'nb_accepted': state.nb_accepted,
+                          'nb_swaps': nb_swaps[c],
+                          'iteration': state.iteration,
+                          'stop_reason': state.stop_reason}
+                         for c, (data, state) in enumerate(zip(datas,
+                                                               states))]
+        if self.aborted():
+            result.stop_reason = STOP_ABORTED
+        elif all(state.stop_reason for state in states):
+            result.stop_reason = best.stop_reason
+        return result
+
+    def run_leastsq(self, resume=None):
+        """
+        Trust-region least squares fit of the free coefficients within the
+        bounds of the model (see leastsq_bounds), with the analytic
+        Jacobian. Starting values out of the bounds are moved onto them
+        with move_to_bounds only.
+        The best parameters met are checkpointed; the minimizer cannot be
+        resumed where it stopped: resume (a checkpoint) starts a new fit
+        from the best parameters of the previous one.
+        """
+        m = self.model
+        par = m.par
+        if resume is not None:
+            par = self.resume_state(resume, FIT_LEASTSQ)['par']
+        out = out_of_bounds(m, par)
+        if len(out) > 0:
+            if not self.move_to_bounds:
+                raise ValueError(str(len(out)) + " starting values out " +
+                                 "of the bounds of the leastsq fit")
+            logger.log(logging.WARNING, str(len(out)) + " starting " +
+                       "values out of the bounds are moved onto them")
+        lower, upper = leastsq_bounds(m)
+        lower = lower[self.par_map.free]
+        upper = upper[self.par_map.free]
+        x = self.par_map.pack(par)
+        output = least_squares(self.residual_leastsq,
+                               np.clip(x, lower, upper),
+                               jac=self.jacobian_leastsq,
+                               bounds=(lower, upper), method='trf',
+                               ftol=m.data['ftol'], xtol=m.data['xtol'],
+                               max_nfev=int(m.data['maxfev']) * (len(x) + 1),
+                               args=(m.Iobs, m.th))
+        if self.p_best is not None:
+            self.save_checkpoint(FIT_LEASTSQ, {'par': self.p_best,
+                                               'E': self.E_best}, True)
+        result = self.result(self.par_map.unpack(output.x), output.success,
+                             output)
+        result.bounded = True
+        result.at_bounds = list(self.par_map.free[output.active_mask != 0])
+        return result
+
+    def run_lmfit(self):
+        from lmfit import minimize
+        m = self.model
+        fit_params, self.lmfit_names = lmfit_parameters(m)
+        maxfev_ = int(m.data['maxfev']) * (len(fit_params) + 1)
+        output = minimize(self.residual_lmfit, fit_params, args=(m.th,),
+                          iter_cb=self.per_iteration,
+                          Dfun=self.jacobian_lmfit, scale_covar=True,
+                          kws={'y': m.Iobs}, maxfev=(maxfev_),
+                          ftol=m.data['ftol'], xtol=m.data['xtol'])
+        par = concatenate((m.sp, m.dwp))
+        for i, name in enumerate(self.lmfit_names):
+            par[i] = output.params[name].value
+        return self.result(par, output.success, output)
+
+    def run(self, fit_type=FIT_GSA, resume=None):
+        """
+        Fit of the model (FIT_GSA, FIT_LEASTSQ, FIT_LMFIT), a Fit_result;
+        resume: checkpoint (see load_checkpoint) of a GSA or leastsq fit to
+        carry on with
+        """
+        if fit_type != FIT_LMFIT and len(self.par_map.free) == 0:
+            logger.log(logging.WARNING, "No coefficient to fit")
+            return self.result(self.model.par, False)
+        if fit_type == FIT_LMFIT:
+            if resume is not None:
+                raise ValueError("lmfit fits cannot be resumed")
+            return self.run_lmfit()
+        elif fit_type == FIT_LEASTSQ:
+            return self.run_leastsq(resume)
+        return self.run_gsa(resume)
+
+
+def fit(model, fit_type=FIT_GSA, resume=None, **callbacks):
+    """
+    Fit of model without GUI, see Fit_engine for the callbacks and
+    checkpoint, and Fit_engine.run for resume
+    """
+    return Fit_engine(model, fit_type=fit_type,
+                      **callbacks).run(fit_type, resume)
+
+
+# =============================================================================
+# GSA chains run in the worker processes
+# =============================================================================
+chain_engine = None
+
+
+def chain_init(model, abort):
+    """Fit_engine of a worker process, abort being set to stop the chains"""
+    global chain_engine
+    chain_engine = Fit_engine(model)
+    chain_engine.chain_abort = abort
+
+
+def chain_segment(args):
+    """Carry on with an annealing chain (data, state) until last_cycle"""
+    data, state, last_cycle = args
+    par_scale, par_limits = chain_engine.gsa_bounds()
+    return gsa(chain_engine.energy, None, par_scale, par_limits,
+               data, ignore, ignore, ignore, chain_engine.chain_abort.is_set,
+               state=state, last_cycle=last_cycle,
+               **chain_engine.gsa_moves())
@@ -8,30 +8,27 @@
 # =============================================================================
 
 
+import os
+import pickle
+
 import wx
 from wx.lib.pubsub import pub
+import wx.lib.agw.genericmessagedialog as GMD
 
 import Parameters4Radmax as p4R
-from Parameters4Radmax import P4Rm
+from Parameters4Radmax import P4Rm, current_project
 import Settings4Radmax as S4R
 
 from Calcul4Radmax import Calcul4Radmax
 
-from threading import Thread, Event
-from scipy.optimize import leastsq
-from scipy import convolve, in1d, log10
-
-from time import sleep
-
+from threading import Thread, Event, Lock
+from scipy import log10
 import numpy as np
-from numpy import around, array, arange, asarray
-
-from Def_XRD4Radmax import f_Refl, f_Refl_fit
-
-from GSA4Radmax import gsa
 
-from Def_Strain4Radmax import f_strain
-from Def_DW4Radmax import f_DW
+from Def_XRD4Radmax import f_Refl
+from FitEngine4Radmax import (Fit_engine, Fit_checkpoint, fit_model,
+                              lmfit_parameters, load_checkpoint,
+                              out_of_bounds, FIT_LEASTSQ, FIT_LMFIT)
 
 import logging
 
@@ -50,6 +47,14 @@ pubsub_save_project_before_fit = "SaveProjectBeforeFit"
 pubsub_adjust_nb_cycle = "AdjustNbCycle"
 
 
+# -----------------------------------------------------------------------------
+def checkpoint_path():
+    """Checkpoint file of the fits of the current project"""
+    a = P4Rm()
+    return os.path.join(a.PathDict['path2ini'],
+                        a.PathDict['namefromini'] + p4R.checkpoint_ext)
+
+
 # -----------------------------------------------------------------------------
 class Fitting4Radmax():
     def on_launch_fit(self):
@@ -79,7 +84,10 @@ class Fitting4Radmax():
             pub.sendMessage(pubsub_save_project_before_fit, case=2)
 
     def onLaunchtest(self):
+        P4Rm.move_to_bounds = False
         test_deformation_limit = self.on_test_data_before_fit()
+        if test_deformation_limit is not True:
+            test_deformation_limit = self.on_test_leastsq_start()
         if test_deformation_limit is True:
             self.on_launch_thread()
         else:
@@ -143,6 +151,31 @@ class Fitting4Radmax():
             else:
                 return True
 
+    def on_test_leastsq_start(self):
+        """
+        Whether the leastsq fit (not lmfit) may start from coefficients out
+        of the deformation limits: none of them is out of the bounds of the
+        fit, or the user agrees to move them onto the bounds
+        """
+        a = P4Rm()
+        if a.fit_type != 1 or a.lmfit_install:
+            return False
+        nb_out = len(out_of_bounds(fit_model(current_project())))
+        if nb_out == 0:
+            return True
+        _msg = (str(nb_out) + " starting values are out of the bounds " +
+                "of the leastsq fit.\nMove them onto the bounds?\n" +
+                "(No: modify the deformation limits)")
+        dlg = GMD.GenericMessageDialog(None, _msg, "Attention",
+                                       agwStyle=wx.YES_NO |
+                                       wx.ICON_QUESTION)
+        result = dlg.ShowModal()
+        dlg.Destroy()
+        if result == wx.ID_YES:
+            P4Rm.move_to_bounds = True
+            return True
+        return False
+
     def on_launch_thread(self):
         a = P4Rm()
         if a.fit_type == 0:
@@ -156,12 +189,22 @@ class Fitting4Radmax():
         P4Rm.ParamDictbackup['I_i'] = a.ParamDict['I_i']
         pub.sendMessage(pubsub_OnFit_Graph)
         pub.sendMessage(pubsub_on_refresh_GUI, option=0, case=0)
-        sleep(0.3)
-        pub.sendMessage(pubsub_on_launch_thread)
+        # let the GUI refresh before the fit thread starts
+        wx.CallAfter(pub.sendMessage, pubsub_on_launch_thread)
 
     def on_stop_fit(self):
         P4Rm.FitDict['worker_live'].stop()
 
+    def on_resume_fit(self):
+        """Carry on with the last fit of the project from its checkpoint"""
+        if not os.path.isfile(checkpoint_path()):
+            logger.log(logging.WARNING, "No fit to resume: " +
+                       checkpoint_path() + " is not present")
+            return
+        logger.log(logging.INFO, "Resume the fit of " + checkpoint_path())
+        P4Rm.resume_fit = True
+        self.on_launch_fit()
+
     def on_fit_ending(self, case):
         a = P4Rm()
         P4Rm.ParamDict['I_i'] = a.ParamDict['I_fit']
@@ -373,86 +416,10 @@ class Fitting4Radmax():
         if not a.lmfit_install:
             return False
         else:
-            from lmfit import Parameters
-            fit_params = Parameters()
-            if a.AllDataDict['model'] == 2:
-                fit_params.add('heigt_strain', value=a.ParamDict['sp'][0],
-                               min=a.AllDataDict['strain_height_min'],
-                               max=a.AllDataDict['strain_height_max'],
-                               vary=a.ParamDict['state_sp'][0])
-                fit_params.add('loc_strain', value=a.ParamDict['sp'][1],
-                               min=0.,
-                               max=1.,
-                               vary=a.ParamDict['state_sp'][1])
-                fit_params.add('fwhm_1_strain', value=a.ParamDict['sp'][2],
-                               min=0.,
-                               max=1.,
-                               vary=a.ParamDict['state_sp'][2])
-                fit_params.add('fwhm_2_strain', value=a.ParamDict['sp'][3],
-                               min=0.,
-                               max=1.,
-                               vary=a.ParamDict['state_sp'][3])
-                fit_params.add('strain_eta_1', value=a.ParamDict['sp'][4],
-                               min=a.AllDataDict['strain_eta_min'],
-                               max=a.AllDataDict['strain_eta_max'],
-                               vary=a.ParamDict['state_sp'][4])
-                fit_params.add('strain_eta_2', value=a.ParamDict['sp'][5],
-                               min=a.AllDataDict['strain_eta_min'],
-                               max=a.AllDataDict['strain_eta_max'],
-                               vary=a.ParamDict['state_sp'][5])
-                fit_params.add('bkg_strain', value=a.ParamDict['sp'][6],
-                               min=a.AllDataDict['strain_bkg_min'],
-                               max=a.AllDataDict['strain_bkg_max'],
-                               vary=a.ParamDict['state_sp'][6])
-
-                fit_params.add('heigt_dw', value=a.ParamDict['dwp'][0],
-                               min=a.AllDataDict['dw_height_min'],
-                               max=a.AllDataDict['dw_height_max'],
-                               vary=a.ParamDict['state_sp'][0])
-                fit_params.add('loc_dw', value=a.ParamDict['dwp'][1],
-                               min=0.,
-                               max=1.,
-                               vary=a.ParamDict['state_dwp'][1])
-                fit_params.add('fwhm_1_dw', value=a.ParamDict['dwp'][2],
-                               min=0.,
-                               max=1.,
-                               vary=a.ParamDict['state_dwp'][2])
-                fit_params.add('fwhm_2_dw', value=a.ParamDict['dwp'][3],
-                               min=0.,
-                               max=1.,
-                               vary=a.ParamDict['state_dwp'][3])
-                fit_params.add('dw_eta_1', value=a.ParamDict['dwp'][4],
-                               min=a.AllDataDict['dw_eta_min'],
-                               max=a.AllDataDict['dw_eta_max'],
-                               vary=a.ParamDict['state_dwp'][4])
-                fit_params.add('dw_eta_2', value=a.ParamDict['dwp'][5],
-                               min=a.AllDataDict['dw_eta_min'],
-                               max=a.AllDataDict['dw_eta_max'],
-                               vary=a.ParamDict['state_dwp'][5])
-                fit_params.add('bkg_dw', value=a.ParamDict['dwp'][6],
-                               min=a.AllDataDict['dw_bkg_min'],
-                               max=a.AllDataDict['dw_bkg_max'],
-                               vary=a.ParamDict['state_dwp'][6])
-            else:
-                P4Rm.name4lmfit = []
-                for ii in range(len(a.ParamDict['sp'])):
-                    name = 'sp_' + str(ii)
-                    fit_params.add(name, value=a.ParamDict['sp'][ii],
-                                   min=a.AllDataDict['strain_min'],
-                                   max=a.AllDataDict['strain_max'],
-                                   vary=a.ParamDict['state_sp'][ii])
-                    P4Rm.name4lmfit.append(name)
-                fit_params.add('nb_sp_val', value=len(a.ParamDict['sp']),
-                               vary=False)
-                for jj in range(len(a.ParamDict['dwp'])):
-                    name = 'dwp_' + str(jj)
-                    fit_params.add(name, value=a.ParamDict['dwp'][jj],
-                                   min=a.AllDataDict['dw_min'],
-                                   max=a.AllDataDict['dw_max'],
-                                   vary=a.ParamDict['state_dwp'][jj])
-                    P4Rm.name4lmfit.append(name)
-                fit_params.add('nb_dwp_val', value=len(a.ParamDict['dwp']),
-                               vary=False)
+            fit_params, names = lmfit_parameters(
+                fit_model(current_project()))
+            if a.AllDataDict['model'] != 2:
+                P4Rm.name4lmfit = names
             P4Rm.FitDict['fit_params'] = fit_params
             return True
 
@@ -525,56 +492,71 @@ class Live_NbCycle(wx.PyCommandEvent):
         return self._value
 
 
+# -----------------------------------------------------------------------------
+class Progress_publisher(Thread):
+    """
+    Posts the latest snapshot of the fit to the GUI every period seconds.
+    The fit thread only replaces the pending snapshot and never waits: the
+    snapshots it replaces before they are posted are dropped.
+    """
+    def __init__(self, parent, period=p4R.progress_period):
+        Thread.__init__(self)
+        self.daemon = True
+        self.parent = parent
+        self.period = period
+        self.lock = Lock()
+        self.frame = None
+        self.done = Event()
+        self.start()
+
+    def publish(self, y_cal, data=None, deformation=None):
+        with self.lock:
+            self.frame = (y_cal, data, deformation)
+
+    def flush(self):
+        with self.lock:
+            frame, self.frame = self.frame, None
+        if frame is not None:
+            evt = LiveEvent(S4R.Live_COUNT, -1, *frame)
+            wx.PostEvent(self.parent, evt)
+
+    def run(self):
+        while not self.done.wait(self.period):
+            self.flush()
+
+    def close(self):
+        """Stop the channel, posting the last pending snapshot"""
+        self.done.set()
+        self.join()
+        self.flush()
+
+
 # -----------------------------------------------------------------------------
 class Fit_launcher(Thread):
-    def __init__(self, parent, choice=None):
+    """
+    Runs the fit of a project (by default the project of the GUI) in a
+    Fit_engine and reports its progress to the GUI. The fit works on a
+    snapshot of the project taken at launch, the GUI can edit the project
+    meanwhile.
+    The fit is checkpointed in checkpoint_path(), resume carries on with
+    the fit of the last checkpoint. move_to_bounds: the user agreed to
+    move the leastsq starting values out of the bounds onto them.
+    """
+    def __init__(self, parent, choice=None, project=None, resume=False,
+                 move_to_bounds=False):
         Thread.__init__(self)
         self.parent = parent
         self.choice = choice
+        if project is None:
+            project = current_project()
+        self.project = project.snapshot()
+        self.checkpoint = Fit_checkpoint(checkpoint_path())
+        self.resume = resume
+        self.move_to_bounds = move_to_bounds
         self.need_abort = 0
-        self.launch = 0
-        self.count = 0
-        self.gauge_counter = 0
-        self.const = 0
-        self.pars_value = 0
-        self.len_sp = 0
-        self.len_dwp = 0
-        self.Data4f_Refl = []
-        self._stop = Event()
+        self.engine = None
+        self.progress = None
         self.start()
-        self.ii = 1
-
-    def init_array(self):
-        a = P4Rm()
-        const_all = []
-        const_all.append(a.AllDataDict['wavelength'])
-        const_all.append(a.AllDataDict['damaged_depth'])
-        const_all.append(a.AllDataDict['number_slices'])
-
-        const_all.append(a.ConstDict['phi'])
-        const_all.append(a.ParamDict['t_l'])
-        const_all.append(a.ParamDict['b_S'])
-        const_all.append(a.ParamDict['thB_S'])
-        const_all.append(a.ParamDict['G'])
-        const_all.append(a.ParamDict['F0'])
-        const_all.append(a.ParamDict['FH'])
-        const_all.append(a.ParamDict['FmH'])
-
-        const_all.append(a.ParamDict['b_S_s'])
-        const_all.append(a.ParamDict['thB_S_s'])
-        const_all.append(a.ParamDict['G_s'])
-        const_all.append(a.ParamDict['F0_s'])
-        const_all.append(a.ParamDict['FH_s'])
-        const_all.append(a.ParamDict['FmH_s'])
-        const_all.append(a.AllDataDict['film_thick'])
-        const_all.append(a.AllDataDict['dw_thick'])
-
-        const_all.append(a.ParamDict['th'])
-        const_all.append(len(a.ParamDict['z']))
-
-        self.const = const_all
-        self.len_sp = len(a.ParamDict['sp'])
-        self.len_dwp = len(a.ParamDict['dwp'])
 
     def on_limit_exceeded(self, val):
         if self.need_abort == 0:
@@ -585,174 +567,41 @@ class Fit_launcher(Thread):
         evt = Live_NbCycle(S4R.Live_count_NbCycle, -1, val)
         wx.PostEvent(self.parent, evt)
 
-    def per_iteration(self, pars, iter, resid, *args, **kws):
-        a = P4Rm()
-        if self.need_abort == 1:
-            return True
-        if iter < 3 or iter % 10 == 0:
-            y_cal = self.residual_lmfit4iteration(pars)
-            p = []
-            if a.AllDataDict['model'] == 2:
-                for j in p4R.asym_pv_list:
-                    p.append(pars[j].value)
-            else:
-                for j in a.name4lmfit:
-                    p.append(pars[j].value)
-            P4Rm.ParamDict['_fp_min'] = p
-            deformation = [p]
-            self.f_strain_DW()
-            sleep(0.5)
-            evt = LiveEvent(S4R.Live_COUNT, -1, y_cal, None, deformation)
-            wx.PostEvent(self.parent, evt)
-            sleep(0.5)
-
-    def strain_DW(self, pars=None):
-        a = P4Rm()
-        self.Data4f_Refl = []
-        if pars is None:
-            strain = f_strain(a.ParamDict['z'],
-                              a.ParamDict['_fp_min'][:self.len_sp:],
-                              a.AllDataDict['damaged_depth'],
-                              a.splinenumber[0])
-            DW = f_DW(a.ParamDict['z'],
-                      a.ParamDict['_fp_min'][self.len_sp:self.len_sp +
-                      self.len_dwp:],
-                      a.AllDataDict['damaged_depth'], a.splinenumber[1])
-        else:
-            if a.AllDataDict['model'] == 0:
-                spline_DW = 5
-                spline_strain = 5
-            elif a.AllDataDict['model'] == 1:
-                spline_DW = 6
-                spline_strain = 6
-            elif a.AllDataDict['model'] == 2:
-                spline_DW = 4
-                spline_strain = 4
-            self.pars4numba(pars)
-            strain = f_strain(a.ParamDict['z'], self.pars_value,
-                              a.AllDataDict['damaged_depth'], spline_strain)
-            DW = f_DW(a.ParamDict['z'], self.pars_value,
-                      a.AllDataDict['damaged_depth'], spline_DW)
-        strain.astype(np.float64)
-        DW.astype(np.float64)
-        self.Data4f_Refl.append(strain)
-        self.Data4f_Refl.append(DW)
-        self.Data4f_Refl.append(self.const)
-
-    def residual_lmfit4iteration(self, pars):
-        a = P4Rm()
-        res = f_Refl_fit(a.AllDataDict['geometry'], self.Data4f_Refl)
-        y_cal = convolve(abs(res) ** 2, a.ParamDict['resol'], mode='same')
-        y_cal = y_cal / y_cal.max() + a.AllDataDict['background']
-        return y_cal
-
-    def residual_lmfit(self, pars, x, y):
-        a = P4Rm()
-        self.strain_DW(pars)
-        res = f_Refl_fit(a.AllDataDict['geometry'], self.Data4f_Refl)
-        y_cal = convolve(abs(res) ** 2, a.ParamDict['resol'], mode='same')
-        y_cal = y_cal / y_cal.max() + a.AllDataDict['background']
-        return (log10(y) - log10(y_cal))
-
-    def residual_leastsq(self, p, y, x):
-        a = P4Rm()
-        P4Rm.ParamDict['_fp_min'] = p
-        self.strain_DW()
-        res = f_Refl_fit(a.AllDataDict['geometry'], self.Data4f_Refl)
-        y_cal = convolve(abs(res) ** 2, a.ParamDict['resol'], mode='same')
-        y_cal = y_cal / y_cal.max() + a.AllDataDict['background']
-        self.count += 1
-        if self.count % 50 == 0:
-            self.f_strain_DW()
-            sleep(0.2)
-            deformation = [p]
-            evt = LiveEvent(S4R.Live_COUNT, -1, y_cal, None, deformation)
-            wx.PostEvent(self.parent, evt)
-        if self.need_abort == 1:
-            return (log10(y_cal) - log10(y_cal))
-        else:
-            return (log10(y) - log10(y_cal))
-
-    def residual_square(self, p, E_min, nb_minima):
-        a = P4Rm()
-        P4Rm.ParamDict['_fp_min'] = p
-        self.strain_DW()
-        res = f_Refl_fit(a.AllDataDict['geometry'], self.Data4f_Refl)
-        y_cal = convolve(abs(res) ** 2, a.ParamDict['resol'], mode='same')
-        y_cal = y_cal / y_cal.max() + a.AllDataDict['background']
-        y_obs = a.ParamDict['Iobs']
-        self.on_pass_data_to_thread(y_cal, p, E_min, nb_minima)
-        return ((log10(y_obs) - log10(y_cal)) ** 2).sum() / len(y_cal)
-
-    def pars4numba(self, pars):
-        a = P4Rm()
-        vals = pars.valuesdict()
-        const = []
-        if a.AllDataDict['model'] == 2:
-            for name in p4R.asym_pv_list:
-                const.append(vals[name])
-        else:
-            len_sp = int(vals['nb_sp_val'])
-            len_dwp = int(vals['nb_dwp_val'])
-            const.append(len_sp)
-            const.append(len_dwp)
-            for ii in range(len_sp):
-                name = 'sp_' + str(ii)
-                const.append(vals[name])
-            for ii in range(len_dwp):
-                name = 'dwp_' + str(ii)
-                const.append(vals[name])
-        self.pars_value = np.asarray(const, dtype=np.float64, order={'C'})
-
-    def on_pass_data_to_thread(self, y_cal, p, E_min, nb_minima):
-        self.count += 1
-        if self.count == 1:
-            self.f_strain_DW()
-            sleep(0.5)
-            evt = LiveEvent(S4R.Live_COUNT, -1, [])
-            wx.PostEvent(self.parent, evt)
-            sleep(0.2)
-        elif self.count % 10 == 0:
-            self.f_strain_DW()
-            sleep(0.5)
-            data = [E_min, nb_minima]
-            deformation = [p]
-            evt = LiveEvent(S4R.Live_COUNT, -1, y_cal, data, deformation)
-            wx.PostEvent(self.parent, evt)
-            sleep(0.2)
-
     def run(self):
-        a = P4Rm()
         P4Rm.par_fit = []
-        P4Rm.gsa_loop = 0
         evt = LiveEvent(S4R.Live_COUNT, -1, [])
         wx.PostEvent(self.parent, evt)
-        self.init_array()
-
-        if self.choice == 1 or self.choice == 2:
-            if a.lmfit_install:
-                func = self.residual_lmfit
-            else:
-                func = self.residual_leastsq
-            if self.choice == 1:
-                P4Rm.par_fit, P4Rm.success = leastsq(func, a.ParamDict['par'],
-                                                     args=(a.ParamDict['Iobs'],
-                                                           a.ParamDict['th']))
-            elif self.choice == 2:
-                from lmfit import minimize
-                maxfev_ = int(a.AllDataDict['maxfev']) * (len(a.FitDict['fit_params']) + 1)
-                P4Rm.resultFit = minimize(func, a.FitDict['fit_params'],
-                                          args=(a.ParamDict['th'],),
-                                          iter_cb=self.per_iteration,
-                                          scale_covar=True,
-                                          kws={'y': a.ParamDict['Iobs']},
-                                          maxfev=(maxfev_),
-                                          ftol=a.AllDataDict['ftol'],
-                                          xtol=a.AllDataDict['xtol'])
-        elif self.choice == 0:
-            func = self.residual_square
-            P4Rm.par_fit = gsa(func, self.on_limit_exceeded,
-                               self.on_count_cycles, a.AllDataDict)
+        self.progress = Progress_publisher(self.parent)
+        self.engine = Fit_engine(fit_model(self.project),
+                                 self.progress.publish,
+                                 self.on_limit_exceeded,
+                                 self.on_count_cycles, self.choice,
+                                 self.checkpoint, self.move_to_bounds)
+        if self.need_abort == 1:
+            self.engine.stop()
+        result = None
+        if self.resume:
+            try:
+                result = self.engine.run(self.choice,
+                                         load_checkpoint(self.checkpoint.path))
+            except (IOError, EOFError, ValueError,
+                    pickle.UnpicklingError) as e:
+                logger.log(logging.WARNING, "Cannot resume the fit (" +
+                           str(e) + "), starting a new one")
+        if result is None:
+            result = self.engine.run(self.choice)
+        P4Rm.par_fit = result.par
+        P4Rm.stop_reason = result.stop_reason
+        if result.stop_reason is not None:
+            logger.log(logging.INFO, "GSA stopped: " + result.stop_reason)
+        if self.choice == FIT_LEASTSQ:
+            P4Rm.success = result.success
+            logger.log(logging.INFO, "Bounded leastsq fit, " +
+                       str(len(result.at_bounds)) +
+                       " coefficients on their bounds")
+        elif self.choice == FIT_LMFIT:
+            P4Rm.resultFit = result.output
+        self.progress.close()
         if self.need_abort == 1:
             evt = LiveEvent(S4R.Live_COUNT, -1, [], None, None, 1)
             wx.PostEvent(self.parent, evt)
@@ -762,120 +611,6 @@ class Fit_launcher(Thread):
             wx.PostEvent(self.parent, evt)
 
     def stop(self):
-        self._stop.set()
-        P4Rm.gsa_loop = 1
         self.need_abort = 1
-
-    def f_strain_DW(self):
-        a = P4Rm()
-        P4Rm.ParamDict['sp'] = a.ParamDict['_fp_min'][:int(a.AllDataDict['strain_basis_func'])]
-        P4Rm.ParamDict['dwp'] = a.ParamDict['_fp_min'][-1 * int(a.AllDataDict['dw_basis_func']):]
-
-        P4Rm.ParamDict['DW_i'] = f_DW(
-            a.ParamDict['z'], a.ParamDict['dwp'],
-            a.AllDataDict['damaged_depth'],
-            a.AllDataDict['model'])
-        P4Rm.ParamDict['strain_i'] = f_strain(
-            a.ParamDict['z'], a.ParamDict['sp'],
-            a.AllDataDict['damaged_depth'],
-            a.AllDataDict['model'])
-
-        t = a.AllDataDict['damaged_depth']
-        self.on_shifted_sp_curves(t)
-        self.on_shifted_dwp_curves(t)
-
-    def on_shifted_dwp_curves(self, t):
-        a = P4Rm()
-        if a.AllDataDict['model'] == 0:
-            temp_1 = arange(2, len(a.ParamDict['dwp']) + 1)
-            temp_2 = temp_1 * t / (len(a.ParamDict['dwp']))
-            P4Rm.ParamDict['x_dwp'] = t - temp_2
-            shifted_dwp = a.ParamDict['dwp'][:-1:]
-            temp_3 = in1d(around(a.ParamDict['depth'], decimals=3),
-                          around(a.ParamDict['x_dwp'], decimals=3))
-            temp_4 = a.ParamDict['DW_i'][temp_3]
-            P4Rm.ParamDict['scale_dw'] = shifted_dwp / temp_4
-            P4Rm.ParamDict['scale_dw'][a.ParamDict['scale_dw'] == 0] = 1.
-
-            P4Rm.ParamDict['DW_shifted'] = shifted_dwp / a.ParamDict['scale_dw']
-            P4Rm.ParamDict['dw_out'] = a.ParamDict['dwp'][-1]
-
-        elif a.AllDataDict['model'] == 1:
-            temp_1 = arange(0, len(a.ParamDict['dwp']) + 1 - 3)
-            temp_2 = temp_1 * t / (len(a.ParamDict['dwp']) - 3)
-            P4Rm.ParamDict['x_dwp'] = t - temp_2
-            shifted_dwp = a.ParamDict['dwp'][1:-1:]
-            temp_3 = in1d(around(a.ParamDict['depth'], decimals=3),
-                          around(a.ParamDict['x_dwp'], decimals=3))
-            temp_4 = a.ParamDict['DW_i'][temp_3]
-            P4Rm.ParamDict['scale_dw'] = shifted_dwp / temp_4
-            P4Rm.ParamDict['scale_dw'][a.ParamDict['scale_dw'] == 0] = 1.
-
-            P4Rm.ParamDict['DW_shifted'] = shifted_dwp / a.ParamDict['scale_dw']
-            temp_5 = array([a.ParamDict['dwp'][0], a.ParamDict['dwp'][-1]])
-            P4Rm.ParamDict['dw_out'] = temp_5
-
-        elif a.AllDataDict['model'] == 2:
-            x_dw_temp = []
-            x_dw_temp.append(t * (1 - a.ParamDict['dwp'][1]))
-            x_dw_temp.append(t * (1 - a.ParamDict['dwp'][1] +
-                                  a.ParamDict['dwp'][2] / 2))
-            x_dw_temp.append(t * (1 - a.ParamDict['dwp'][1] -
-                                  a.ParamDict['dwp'][3] / 2))
-            x_dw_temp.append(t * 0.05)
-            P4Rm.ParamDict['x_dwp'] = x_dw_temp
-
-            y_dw_temp = []
-            y_dw_temp.append(a.ParamDict['dwp'][0])
-            y_dw_temp.append(1. - (1 - a.ParamDict['dwp'][0]) / 2)
-            y_dw_temp.append(1. - (1 - a.ParamDict['dwp'][0]) / 2 -
-                             (1 - a.ParamDict['dwp'][6]) / 2)
-            y_dw_temp.append(a.ParamDict['dwp'][6])
-            P4Rm.ParamDict['DW_shifted'] = y_dw_temp
-
-    def on_shifted_sp_curves(self, t):
-        a = P4Rm()
-        if a.AllDataDict['model'] == 0:
-            temp_1 = arange(2, len(a.ParamDict['sp']) + 1)
-            temp_2 = temp_1 * t / (len(a.ParamDict['sp']))
-            P4Rm.ParamDict['x_sp'] = t - temp_2
-            shifted_sp = a.ParamDict['sp'][:-1:]
-            temp_3 = in1d(around(a.ParamDict['depth'], decimals=3),
-                          around(a.ParamDict['x_sp'], decimals=3))
-            temp_4 = a.ParamDict['strain_i'][temp_3]
-            P4Rm.ParamDict['scale_strain'] = shifted_sp / temp_4
-            P4Rm.ParamDict['scale_strain'][a.ParamDict['scale_strain'] == 0] = 1.
-            P4Rm.ParamDict['strain_shifted'] = asarray(shifted_sp) * 100. / a.ParamDict['scale_strain']
-            P4Rm.ParamDict['stain_out'] = a.ParamDict['sp'][-1]
-
-        elif a.AllDataDict['model'] == 1:
-            temp_1 = arange(0, len(a.ParamDict['sp']) + 1 - 3)
-            temp_2 = temp_1 * t / (len(a.ParamDict['sp']) - 3)
-            P4Rm.ParamDict['x_sp'] = t - temp_2
-            shifted_sp = a.ParamDict['sp'][1:-1:]
-            temp_3 = in1d(around(a.ParamDict['depth'], decimals=3),
-                          around(a.ParamDict['x_sp'], decimals=3))
-            temp_4 = a.ParamDict['strain_i'][temp_3]
-            P4Rm.ParamDict['scale_strain'] = shifted_sp / temp_4
-            P4Rm.ParamDict['scale_strain'][a.ParamDict['scale_strain'] == 0] = 1.
-
-            P4Rm.ParamDict['strain_shifted'] = asarray(shifted_sp) * 100. / a.ParamDict['scale_strain']
-            temp_5 = array([a.ParamDict['sp'][0], a.ParamDict['sp'][-1]])
-            P4Rm.ParamDict['stain_out'] = temp_5
-
-        elif a.AllDataDict['model'] == 2:
-            x_sp_temp = []
-            x_sp_temp.append(t * (1 - a.ParamDict['sp'][1]))
-            x_sp_temp.append(t * (1 - a.ParamDict['sp'][1] +
-                                  a.ParamDict['sp'][2] / 2))
-            x_sp_temp.append(t * (1 - a.ParamDict['sp'][1] -
-                                  a.ParamDict['sp'][3] / 2))
-            x_sp_temp.append(t * 0.05)
-            P4Rm.ParamDict['x_sp'] = x_sp_temp
-
-            y_sp_temp = []
-            y_sp_temp.append(a.ParamDict['sp'][0])
-            y_sp_temp.append(a.ParamDict['sp'][0] / 2)
-            y_sp_temp.append(a.ParamDict['sp'][0] / 2 + a.ParamDict['sp'][6] / 2)
-            y_sp_temp.append(a.ParamDict['sp'][6])
-            P4Rm.ParamDict['strain_shifted'] = y_sp_temp
+        if self.engine is not None:
+            self.engine.stop()
@@ -189,6 +189,7 @@ class FittingPanel(scrolled.ScrolledPanel):
         """button part"""
         self.FitId = wx.NewId()
         self.StopFitId = wx.NewId()
+        self.ResumeFitId = wx.NewId()
         self.Restore_strain_Id = wx.NewId()
         self.Restore_dw_Id = wx.NewId()
 
@@ -230,6 +231,10 @@ class FittingPanel(scrolled.ScrolledPanel):
         self.stopfit_Btn.SetFont(font_update)
         self.stopfit_Btn.Bind(wx.EVT_BUTTON, self.on_stop_fit)
         self.stopfit_Btn.Disable()
+        self.resumefit_Btn = wx.Button(self, id=self.ResumeFitId,
+                                       label="Resume fit!")
+        self.resumefit_Btn.SetFont(font_update)
+        self.resumefit_Btn.Bind(wx.EVT_BUTTON, self.on_resume_fit)
 
         self.progressBar = wx.Gauge(self, -1, 50, (-20, 0), (100, 20))
 
@@ -245,7 +250,8 @@ class FittingPanel(scrolled.ScrolledPanel):
 
         in_Fit_box_sizer.Add(self.fit_Btn, pos=(0, 0), flag=flagSizer)
         in_Fit_box_sizer.Add(self.stopfit_Btn, pos=(0, 1), flag=flagSizer)
-        in_Fit_box_sizer.Add(self.progressBar, pos=(0, 2),
+        in_Fit_box_sizer.Add(self.resumefit_Btn, pos=(0, 2), flag=flagSizer)
+        in_Fit_box_sizer.Add(self.progressBar, pos=(0, 3),
                              flag=wx.EXPAND | wx.ALL)
 
         in_GSA_results_sizer.Add(Emin_txt, pos=(0, 0),
@@ -414,8 +420,22 @@ class FittingPanel(scrolled.ScrolledPanel):
             else:
                 b = Fitting4Radmax()
                 P4Rm.fit_type = self.cb_FitAlgo.GetSelection()
+                P4Rm.resume_fit = False
                 b.on_launch_fit()
 
+    def on_resume_fit(self, event):
+        """
+        reprise du dernier fit du projet là où il s'était arrêté, à partir
+        de son checkpoint
+        """
+        a = P4Rm()
+        if a.AllDataDict['damaged_depth'] == 0:
+            pub.sendMessage(pubsub_add_damaged_before_fit)
+        elif a.ParamDict['th'].any():
+            b = Fitting4Radmax()
+            P4Rm.fit_type = self.cb_FitAlgo.GetSelection()
+            b.on_resume_fit()
+
     def on_adjust_nb_cycle(self):
         """
         mise à jour du champ nb_cycle_max.
@@ -434,14 +454,21 @@ class FittingPanel(scrolled.ScrolledPanel):
         """
         a = P4Rm()
         b = Fitting4Radmax()
+        resume = a.resume_fit
+        P4Rm.resume_fit = False
+        move_to_bounds = a.move_to_bounds
+        P4Rm.move_to_bounds = False
         if a.fit_type == 1:
             success = b.on_test_lmfit()
             if success is True:
-                P4Rm.FitDict['worker_live'] = Fit_launcher(self, 2)
+                P4Rm.FitDict['worker_live'] = Fit_launcher(self, 2,
+                                                           resume=resume)
             else:
-                P4Rm.FitDict['worker_live'] = Fit_launcher(self, 1)
+                P4Rm.FitDict['worker_live'] = Fit_launcher(
+                    self, 1, resume=resume, move_to_bounds=move_to_bounds)
         else:
-            P4Rm.FitDict['worker_live'] = Fit_launcher(self, 0)
+            P4Rm.FitDict['worker_live'] = Fit_launcher(self, 0,
+                                                       resume=resume)
 
     def on_refresh_GUI(self, option, case=None):
         """
@@ -457,6 +484,7 @@ class FittingPanel(scrolled.ScrolledPanel):
             self.statusbar.SetStatusText(msg_, 0)
             self.progressBar.Pulse()
             self.fit_Btn.Disable()
+            self.resumefit_Btn.Disable()
             self.stopfit_Btn.Enable()
             self.restore_strain_btn.Disable()
             self.restore_dw_btn.Disable()
@@ -472,6 +500,7 @@ class FittingPanel(scrolled.ScrolledPanel):
             self.progressBar.SetValue(0)
             self.on_disenable_notebook(True)
             self.fit_Btn.Enable()
+            self.resumefit_Btn.Enable()
             self.stopfit_Btn.Disable()
             self.restore_strain_btn.Enable()
             self.restore_dw_btn.Enable()
@@ -558,7 +587,7 @@ class FittingPanel(scrolled.ScrolledPanel):
                             param=int(list4live[1][1]))
         if list4live[2] is not None:
             b = Calcul4Radmax()
-            b.f_strain_DW()
+            b.f_strain_DW(list4live[2][0])
         if stopFit is not None:
             self.on_refresh_GUI(1, stopFit)
             pub.sendMessage(pubsub_OnFit_Graph, b=1)
@@ -4,6 +4,7 @@
 # Radmax project
 
 import numpy as np
+from scipy.fftpack import next_fast_len
 
 
 def f_Gauss(x, param):
@@ -30,6 +31,25 @@ def f_pVoigt(x, param):
     return eta*lorentz + (1-eta)*gauss
 
 
+def f_pVoigt_jac(x, param):
+    """
+    Partial derivatives of f_pVoigt with respect to its four parameters,
+    returned as a (len(x) x 4) array
+    """
+    max_ = param[0]
+    pos = param[1]
+    FWHM = param[2]
+    eta = param[3]
+    u = (x-pos)/(0.5*FWHM)
+    gauss = np.exp(-np.log(2.) * u**2)
+    lorentz = 1. / (1. + u**2)
+    d_u = max_ * (eta*(-2*u*lorentz**2) + (1-eta)*(-2*np.log(2.)*u*gauss))
+    return np.column_stack((eta*lorentz + (1-eta)*gauss,
+                            d_u * (-2./FWHM),
+                            d_u * (-u/FWHM),
+                            max_ * (lorentz - gauss)))
+
+
 def f_gbell(x, param):
     max_ = param[0]
     pos = param[1]
@@ -49,3 +69,54 @@ def f_splitpV(x, param):
     pvr = f_pVoigt(x, [max_, pos, FWHMr, etar])
     pv[x > pos] = pvr[x > pos]
     return pv
+
+
+class Resol_convolution():
+    """
+    Convolution with the instrumental resolution, same result as
+    np.convolve(x, resol, mode='same').
+    The kernel is trimmed to the points where it exceeds threshold times
+    its maximum; the convolution is then computed directly or, for long
+    kernels, through FFT with the kernel spectrum computed here once.
+    x may also be a (K x n) stack of signals. For non-negative signals the
+    result is floored at eps times its maximum.
+    """
+    def __init__(self, resol, n, threshold=1e-10):
+        resol = np.asarray(resol, dtype=float)
+        keep = np.nonzero(abs(resol) > threshold * abs(resol).max())[0]
+        lo, hi = keep[0], keep[-1] + 1
+        self.kernel = resol[lo:hi]
+        self.n = n
+        # index, in the full convolution by the trimmed kernel, of the first
+        # point of the 'same' window of the full kernel
+        self.offset = (len(resol) - 1) // 2 - lo
+        self.full = n + len(self.kernel) - 1
+        self.positive = self.kernel.min() >= 0
+        self.nfft = next_fast_len(self.full)
+        self.use_fft = (len(self.kernel) > 64 and n * len(self.kernel) >
+                        5 * self.nfft * np.log2(self.nfft))
+        if self.use_fft:
+            self.spectrum = np.fft.rfft(self.kernel, self.nfft)
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.use_fft:
+            full = np.fft.irfft(np.fft.rfft(x, self.nfft, axis=-1) *
+                                self.spectrum, self.nfft, axis=-1)
+            full = full[..., :self.full]
+        elif x.ndim == 1:
+            full = np.convolve(x, self.kernel)
+        else:
+            full = np.array([np.convolve(row, self.kernel) for row in x])
+        out = np.zeros(x.shape)
+        start = max(self.offset, 0)
+        stop = min(self.offset + self.n, self.full)
+        if stop > start:
+            out[..., start - self.offset:stop - self.offset] = \
+                full[..., start:stop]
+        if self.positive and x.min() >= 0:
+            # intensities: the round-off of the transforms and the trimmed
+            # tails of the kernel must not give values <= 0 (log scale)
+            floor = np.finfo(float).eps * out.max(axis=-1)
+            out = np.maximum(out, np.asarray(floor)[..., None])
+        return out
@@ -7,15 +7,11 @@
 # GSA Module
 # =============================================================================
 
-import scipy.stats as stats
-from scipy import rand
-from pylab import normal
+from time import time
 
-from Parameters4Radmax import P4Rm
-
-from Def_XRD4Radmax import f_Refl
 import numpy as np
-from numpy import append, ones, zeros, linspace, log10, concatenate
+from numpy import append, array, broadcast_to, ones, zeros, nonzero
+from numpy.random import default_rng
 
 
 # -----------------------------------------------------------------------------
@@ -59,15 +55,20 @@ def accept_prob(Delta_E, T, qa):
             return ((1. + ((qa-1.)*Delta_E/T))**(1./(1.-qa)))
 
 
-def tsallis_rv(qv, Tqv, D):
+def tsallis_rv(qv, Tqv, D, rng=None):
+    """
+    D independent draws of the one-dimensional Tsallis visiting
+    distribution at the temperature Tqv, taken from the numpy Generator
+    rng in two vectorized calls
+    """
+    if rng is None:
+        rng = default_rng()
     p = (3.-qv)/(2*(qv-1))
     s = ((2.*(qv-1))**0.5) / (Tqv**(1./(3-qv)))
-    rv = zeros(D, dtype=float)
-    x = normal(0, 1, D)
-    u = stats.gamma.rvs(p, loc=0., scale=1., size=1)
+    x = rng.standard_normal(D)
+    u = rng.standard_gamma(p, D)
     y = s*(u**0.5)
-    rv[:] = x[:]/y
-    return rv
+    return x/y
 
 
 def tronque(fp_t, limits):
@@ -102,162 +103,248 @@ def randomize_old_FONCTIONNE(qv, T, D, fp_0, scale, limits):
     return fp_t, depassements
 
 
-def randomize(LimitExceeded, qv, T, D, fp_0, scale, limits):
-    depassements = zeros(D, dtype=float)
-    fp_t = zeros(len(fp_0))
-    fp_t[:] = fp_0[:]
-    for ii in range(len(fp_t)):
-        delta_fp = tsallis_rv(qv, T, 1)[0] * scale[ii]
-        fp_t[ii] = (fp_0[ii] + delta_fp)
-        LimitExceeded(-1)
-        while ((fp_t[ii] < limits[2*ii]) or (fp_t[ii] > limits[2*ii+1])):
-            LimitExceeded(ii)
-            depassements[ii] = 1
-            fp_t[ii] = fp_0[ii]
-            delta_fp = tsallis_rv(qv, T, 1)[0] * scale[ii]
-            fp_t[ii] = (fp_0[ii] + delta_fp)
-    return fp_t, depassements
-
-
-def residual_square(p, data):
-    a = P4Rm()
-    P4Rm.ParamDict['_fp_min'] = p
-    y_cal = f_Refl(a.AllDataDict['geometry'])
-    y_cal = y_cal/y_cal.max() + data['background']
-    temp = ((log10(a.ParamDict['Iobs']) - log10(y_cal))**2).sum()
-    return temp / len(y_cal)
-
-
-# -----------------------------------------------------------------------------
-def gsa(energy, LimitExceeded, count_cycle, data, args=()):
-    a = P4Rm()
-    temp = concatenate((a.ParamDict['state_sp'], a.ParamDict['state_dwp']),
-                       axis=0)
-    par_scale = zeros(len(a.ParamDict['par']))
-    par_scale[temp] = a.ConstDict['jump_scale']
-    sp_limits = zeros(2*len(a.ParamDict['sp']))
-    dwp_limits = zeros(2*len(a.ParamDict['dwp']))
-
-    if a.AllDataDict['model'] == 0. or a.AllDataDict['model'] == 1.:
-        sp_limits[0:(2*len(a.ParamDict['sp']))-1:2] = a.AllDataDict['strain_min']
-        sp_limits[1:(2*len(a.ParamDict['sp'])):2] = a.AllDataDict['strain_max']
-
-        dwp_limits[0:(2*len(a.ParamDict['dwp']))-1:2] = a.AllDataDict['dw_min']
-        dwp_limits[1:(2*len(a.ParamDict['dwp'])):2] = a.AllDataDict['dw_max']
-    elif a.AllDataDict['model'] == 2.:
-        sp_limits[0] = a.AllDataDict['strain_height_min']
-        sp_limits[1] = a.AllDataDict['strain_height_max']
+def randomize(LimitExceeded, qv, T, D, fp_0, scale, limits, rng=None,
+              nb_moves=None):
+    """
+    Tsallis move of all the parameters from fp_0, the coordinates falling
+    out of their limits being drawn again together until they all fit.
+    With nb_moves, a (nb_moves x D) block of independent moves is drawn.
+    LimitExceeded is called once, with the last parameter that went out of
+    its limits during the move (-1 if none did).
+    """
+    if rng is None:
+        rng = default_rng()
+    shape = (D,) if nb_moves is None else (nb_moves, D)
+    lower = broadcast_to(limits[0::2], shape).ravel()
+    upper = broadcast_to(limits[1::2], shape).ravel()
+    fp_0 = broadcast_to(fp_0, shape).ravel()
+    scale = broadcast_to(scale, shape).ravel()
+    fp_t = fp_0 + tsallis_rv(qv, T, fp_0.size, rng) * scale
+    out = nonzero((fp_t < lower) | (fp_t > upper))[0]
+    depassements = zeros(fp_0.size, dtype=float)
+    depassements[out] = 1
+    while len(out) > 0:
+        fp_t[out] = fp_0[out] + tsallis_rv(qv, T, len(out), rng) * scale[out]
+        out = out[(fp_t[out] < lower[out]) | (fp_t[out] > upper[out])]
+    depassements = depassements.reshape(shape)
+    exceeded = nonzero(depassements.reshape(-1, D).any(axis=0))[0]
+    LimitExceeded(exceeded[-1] if len(exceeded) > 0 else -1)
+    return fp_t.reshape(shape), depassements
+
+
+def gsa_limits(data, nb_sp, nb_dwp):
+    """
+    Bounds of the nb_sp strain and nb_dwp DW coefficients, stored as
+    [min_0, max_0, min_1, max_1, ...]
+    """
+    sp_limits = zeros(2*nb_sp)
+    dwp_limits = zeros(2*nb_dwp)
+
+    if data['model'] == 0. or data['model'] == 1.:
+        sp_limits[0:(2*nb_sp)-1:2] = data['strain_min']
+        sp_limits[1:(2*nb_sp):2] = data['strain_max']
+
+        dwp_limits[0:(2*nb_dwp)-1:2] = data['dw_min']
+        dwp_limits[1:(2*nb_dwp):2] = data['dw_max']
+    elif data['model'] == 2.:
+        sp_limits[0] = data['strain_height_min']
+        sp_limits[1] = data['strain_height_max']
         sp_limits[2] = 0.
         sp_limits[3] = 1.
         sp_limits[4] = 0.
         sp_limits[5] = 1.
         sp_limits[6] = 0.
         sp_limits[7] = 1.
-        sp_limits[8] = a.AllDataDict['strain_eta_min']
-        sp_limits[9] = a.AllDataDict['strain_eta_max']
-        sp_limits[10] = a.AllDataDict['strain_eta_min']
-        sp_limits[11] = a.AllDataDict['strain_eta_max']
-        sp_limits[12] = a.AllDataDict['strain_bkg_min']
-        sp_limits[13] = a.AllDataDict['strain_bkg_max']
-
-        dwp_limits[0] = a.AllDataDict['dw_height_min']
-        dwp_limits[1] = a.AllDataDict['dw_height_max']
+        sp_limits[8] = data['strain_eta_min']
+        sp_limits[9] = data['strain_eta_max']
+        sp_limits[10] = data['strain_eta_min']
+        sp_limits[11] = data['strain_eta_max']
+        sp_limits[12] = data['strain_bkg_min']
+        sp_limits[13] = data['strain_bkg_max']
+
+        dwp_limits[0] = data['dw_height_min']
+        dwp_limits[1] = data['dw_height_max']
         dwp_limits[2] = 0.
         dwp_limits[3] = 1.
         dwp_limits[4] = 0.
         dwp_limits[5] = 1.
         dwp_limits[6] = 0.
         dwp_limits[7] = 1.
-        dwp_limits[8] = a.AllDataDict['dw_eta_min']
-        dwp_limits[9] = a.AllDataDict['dw_eta_max']
-        dwp_limits[10] = a.AllDataDict['dw_eta_min']
-        dwp_limits[11] = a.AllDataDict['dw_eta_max']
-        dwp_limits[12] = a.AllDataDict['dw_bkg_min']
-        dwp_limits[13] = a.AllDataDict['dw_bkg_max']
-    par_limits = append(sp_limits, dwp_limits)
-    fp = a.ParamDict['par']
-    qa_var = a.AllDataDict['qa']
-
-    if type(args) != type(()):
-        args = (args,)
-
-#isinstance(bytes, bytearray)
-
-    P4Rm.ParamDict['_fp_min'] = fp
-    fp_0 = zeros(len(fp))
-    fp_min = zeros(len(fp))
-    fp_t = zeros(len(fp))
-    fp_0[:] = fp[:]
-    fp_min[:] = fp[:]
-    fp_t[:] = fp[:]
-    E_0 = residual_square(fp, data)
-    E_min = E_0
-    E_t = E_0
-    nb_rejet = 0
-    nb_minima = 0
-    tmax = data['tmax']/1000
+        dwp_limits[8] = data['dw_eta_min']
+        dwp_limits[9] = data['dw_eta_max']
+        dwp_limits[10] = data['dw_eta_min']
+        dwp_limits[11] = data['dw_eta_max']
+        dwp_limits[12] = data['dw_bkg_min']
+        dwp_limits[13] = data['dw_bkg_max']
+    return append(sp_limits, dwp_limits)
+
+
+# -----------------------------------------------------------------------------
+class Gsa_state():
+    """
+    Everything needed to carry on with an annealing: current point fp_0
+    and energy E_0, best point fp_min and energy E_min, last cycle done,
+    acceptance parameter qa, counters, random generator, recent values of
+    E_min, time spent and reason of an early stop (see Stop_criteria)
+    """
+    def __init__(self, fp, E, qa, rng=None):
+        if rng is None:
+            rng = default_rng()
+        self.fp_0 = array(fp, dtype=float)
+        self.E_0 = E
+        self.fp_min = array(fp, dtype=float)
+        self.E_min = E
+        self.iteration = 0
+        self.qa = qa
+        self.nb_minima = 0
+        self.nb_rejet = 0
+        self.nb_accepted = 0
+        self.rng = rng
+        self.E_min_history = [E]
+        self.elapsed = 0.
+        self.stop_reason = None
+
+
+STOP_PLATEAU = "plateau"
+STOP_REJECTIONS = "rejections"
+STOP_TIME = "time"
+STOP_ABORTED = "aborted"
+
+
+class Stop_criteria():
+    """
+    Early stopping of an annealing, each criterion being disabled by 0:
+    window, tol: E_min has decreased by less than tol (relative) over the
+    last window cycles,
+    nb_rejet_max: that many moves in a row have been rejected,
+    time_max: the annealing has run for time_max seconds
+    """
+    def __init__(self, window=0, tol=1e-4, nb_rejet_max=0, time_max=0.):
+        self.window = window
+        self.tol = tol
+        self.nb_rejet_max = nb_rejet_max
+        self.time_max = time_max
+
+    def check(self, state):
+        """Reason to stop the annealing in state, None to carry on"""
+        history = state.E_min_history
+        if self.window > 0:
+            del history[:-(self.window + 1)]
+            if (len(history) > self.window and
+                    history[0] - history[-1] <= self.tol * abs(history[0])):
+                return STOP_PLATEAU
+        else:
+            del history[:-1]
+        if self.nb_rejet_max > 0 and state.nb_rejet >= self.nb_rejet_max:
+            return STOP_REJECTIONS
+        if self.time_max > 0 and state.elapsed >= self.time_max:
+            return STOP_TIME
+        return None
+
+
+def stop_criteria(data):
+    """
+    Stop_criteria of the settings stop_window, stop_tol, stop_rejections
+    and stop_time of data, None when they are all disabled
+    """
+    if (data['stop_window'] <= 0 and data['stop_rejections'] <= 0 and
+            data['stop_time'] <= 0):
+        return None
+    return Stop_criteria(data['stop_window'], data['stop_tol'],
+                         data['stop_rejections'], data['stop_time'])
 
-#    nombre de paramètres
-    D = len(fp)
-    depassements = zeros(D, dtype=float)
 
-#    définition du tableau de cycle
-    cycle = linspace(1, data['nb_cycle_max'], data['nb_cycle_max'])
-    cycle = [int(ii) for ii in cycle]
-    cycle = np.asarray(cycle, dtype=np.int32)
-
-#    evolution_E = zeros(nb_cycle_max, dtype = float)
-#    evolution_Jump = zeros(nb_cycle_max)
-#    evolution_Param = zeros((nb_cycle_max, D), dtype = float)
-#    evolution_Depass = zeros((nb_cycle_max, D), dtype = float)
-#    définition du tableau de refroidissement
-#    temperature = temp_sch(cycle, Tmax, qt)
-    temperature = temp_sch_stepped(cycle, tmax, a.AllDataDict['qt'],
-                                   data['nb_palier'])
+def gsa_temperature(data):
+    """Temperature of every cycle of the annealing"""
+    cycle = np.arange(1, int(data['nb_cycle_max']) + 1, dtype=np.int32)
+    return temp_sch_stepped(cycle, data['tmax']/1000, data['qt'],
+                            data['nb_palier'])
+
+
+# -----------------------------------------------------------------------------
+def gsa(energy, fp, par_scale, par_limits, data, LimitExceeded, count_cycle,
+        progress, stop, rng=None, state=None, last_cycle=None,
+        energy_batch=None, nb_moves=1, pick='best', stopping=None):
+    """
+    Generalized simulated annealing of energy(p) starting from fp, the
+    jumps of each parameter being scaled by par_scale and bounded by
+    par_limits (see gsa_limits).
+    progress(fp_t, E_min, nb_minima) is called after every trial, the
+    annealing is interrupted as soon as stop() returns True.
+    rng is the numpy Generator of the random moves (a new one by default).
+    The annealing carries on from state when given (fp and rng are then
+    ignored) and stops after last_cycle (default: data['nb_cycle_max']).
+    With nb_moves > 1, nb_moves moves are drawn from the current point at
+    each cycle and scored together by energy_batch (stack of parameters ->
+    energies); the acceptance test is applied to the best of them
+    (pick='best') or to one drawn at random (pick='sample').
+    stopping (Stop_criteria) ends the annealing early, state.stop_reason
+    telling why; an annealing stopped that way is not carried on.
+    Returns the Gsa_state at the end.
+    """
+    if state is None:
+        state = Gsa_state(fp, energy(array(fp, dtype=float)), data['qa'],
+                          rng)
+    if last_cycle is None:
+        last_cycle = int(data['nb_cycle_max'])
+    if state.stop_reason is not None:
+        return state
+    rng = state.rng
+    t_0 = time() - state.elapsed
+    temperature = gsa_temperature(data)
+#    nombre de paramètres
+    D = len(state.fp_0)
 #   début de la boucle de recuit
-    for iteration in cycle:
-        if a.gsa_loop == 1:
+    for iteration in range(state.iteration + 1, last_cycle + 1):
+        if stop():
+            state.stop_reason = STOP_ABORTED
             break
-        elif a.gsa_loop == 0:
-            count_cycle(iteration)
-            index = iteration - 1
-#            lecture de la tempétature
-            T = temperature[index]
-#        randomisation des paramètres
-            fp_t, depassements = randomize(LimitExceeded,
-                                           a.AllDataDict['qv'],
-                                           T, D, fp_0, par_scale,
-                                           par_limits)
-#        calcul de l'énergie du nouvel état
-#                print ("loop= ", iteration)
-            E_t = energy(fp_t, E_min, nb_minima)
-    #        evolution_E[index] = E_0
-    #        evolution_Param[index,:] = fp_0[:]
-    #        evolution_Depass[index, :] = multiply(depassements[:],fp_0[:])
+        count_cycle(iteration)
+#        lecture de la tempétature
+        T = temperature[iteration - 1]
+#        randomisation des paramètres et calcul de l'énergie des nouveaux états
+        if nb_moves > 1:
+            moves, depassements = randomize(LimitExceeded, data['qv'], T, D,
+                                            state.fp_0, par_scale,
+                                            par_limits, rng, nb_moves)
+            E_moves = energy_batch(moves)
+            best = E_moves.argmin()
+            k = best if pick == 'best' else rng.integers(nb_moves)
+            fp_t, E_t = moves[k], E_moves[k]
+            fp_b, E_b = moves[best], E_moves[best]
+        else:
+            fp_t, depassements = randomize(LimitExceeded, data['qv'], T, D,
+                                           state.fp_0, par_scale,
+                                           par_limits, rng)
+            E_t = energy(fp_t)
+            fp_b, E_b = fp_t, E_t
 #        test : si l'energie a baissé, garde les nouveaux paramètres et défini
 #        une nouvelle énergie de référence
-            if (E_t <= E_0):
-                nb_rejet = 0
-                fp_0 = fp_t[:]
-                E_0 = E_t
-    #            evolution_Jump[index] = -1
-    #            evolution_E[index] = E_0
-    #            evolution_Param[index,:] = fp_0[:]
-                if (E_t <= E_min):
-                    nb_minima += 1.
-                    fp_min = fp_t[:]
-                    E_min = E_t
-            else:
-                Delta_E = E_t - E_0
-                qa_var = qa_var - 0.85*iteration
-                Pqa = accept_prob(Delta_E, T, qa_var)
-                alea = rand()
-                if (alea < Pqa):
-                    nb_rejet = 0
-                    fp_0 = fp_t[:]
-                    E_0 = E_t
-    #                evolution_Jump[index] = 1
-    #                evolution_Param[index,:] = fp_0[:]
-                else:
-                    nb_rejet += 1
-    return fp_min
+        if (E_t <= state.E_0):
+            accepted = True
+        else:
+            Delta_E = E_t - state.E_0
+            state.qa = state.qa - 0.85*iteration
+            Pqa = accept_prob(Delta_E, T, state.qa)
+            accepted = rng.random() < Pqa
+        if accepted:
+            state.nb_rejet = 0
+            state.nb_accepted += 1
+            state.fp_0 = fp_t
+            state.E_0 = E_t
+        else:
+            state.nb_rejet += 1
+#        meilleur état rencontré
+        if (E_b <= state.E_min):
+            state.nb_minima += 1
+            state.fp_min = fp_b.copy()
+            state.E_min = E_b
+        state.iteration = iteration
+        progress(fp_b, state.E_min, state.nb_minima)
+        state.elapsed = time() - t_0
+        if stopping is not None:
+            state.E_min_history.append(state.E_min)
+            state.stop_reason = stopping.check(state)
+            if state.stop_reason is not None:
+                break
+    return state
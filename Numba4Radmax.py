@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: A_BOULLE & M_SOUILAH
+# Radmax project
+
+# =============================================================================
+# Compiled (Numba) backend of the slice recurrence
+# =============================================================================
+
+import cmath
+from numpy import atleast_2d, broadcast_to, empty, ascontiguousarray
+
+try:
+    from numba import njit, prange
+    numba_install = True
+except ImportError:
+    numba_install = False
+
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+    prange = range
+
+# bound of the relative deviation from Def_XRD4Radmax.f_Refl_fit
+# (max |r - r_ref| / max |r_ref|): the compiled kernel (Numba 0.68) deviates
+# by at most 3e-8 on the example data for the four geometries and up to 500
+# slices, the deviation growing with the number of slices
+tolerance = 1e-7
+
+
+@njit(parallel=True, cache=True)
+def _refl_kernel(th, res0, alpha, beta, T, out):
+    """
+    Slice recurrence fused in one loop nest: every (candidate, angle) pair
+    runs through all the layers with scalar complex arithmetic only, the
+    pairs are distributed over the threads.
+    th (n_th), res0 (n_th), alpha, beta, T (K x L), out (K x n_th)
+    """
+    K = alpha.shape[0]
+    L = alpha.shape[1]
+    n_th = th.shape[0]
+    for p in prange(K * n_th):
+        k = p // n_th
+        i = p % n_th
+        res = res0[i]
+        for j in range(L):
+            eta = alpha[k, j]*th[i] + beta[k, j]
+            sq = cmath.sqrt(eta*eta - 1)
+            S1 = (res - eta + sq)*cmath.exp(-1j*T[k, j]*sq)
+            S2 = (res - eta - sq)*cmath.exp(1j*T[k, j]*sq)
+            res = eta + sq*((S1 + S2)/(S1 - S2))
+        out[k, i] = res
+
+
+class Refl_numba():
+    """
+    Drop-in replacement for f_Refl_fit (profiles or stacks of profiles)
+    running the compiled kernel; the bottom amplitude and the output
+    buffer are kept between calls of the same fit.
+    Only to be used when numba_install is True, the plain Python kernel
+    is far slower than the NumPy engines.
+    """
+    def __init__(self):
+        self.plan = None
+        self.out = None
+
+    def __call__(self, choice, Data):
+        plan = Data[2]
+        alpha, beta, T = plan.slices(Data[0], Data[1])
+        single = alpha.ndim == 1
+        alpha = atleast_2d(alpha).astype(complex)
+        beta = atleast_2d(beta).astype(complex)
+        T = atleast_2d(T).astype(complex)
+        if plan is not self.plan:
+            self.plan = plan
+            self.th = ascontiguousarray(plan.th, dtype=float)
+            self.res0 = ascontiguousarray(
+                broadcast_to(plan.res0, self.th.shape), dtype=complex)
+        shape = (alpha.shape[0], len(self.th))
+        if self.out is None or self.out.shape != shape:
+            self.out = empty(shape, dtype=complex)
+        _refl_kernel(self.th, self.res0, alpha, beta, T, self.out)
+        if single:
+            return self.out[0].copy()
+        return self.out.copy()
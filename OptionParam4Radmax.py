@@ -583,6 +583,46 @@ class FitParametersPanel(wx.Panel):
 
         AGSA_options_box_sizer.Add(in_AGSA_options_box_sizer, 0, wx.ALL, 5)
 
+        """GSA chains, stopping and XRD engine part"""
+        _msg = (" GSA chains, moves and stopping criteria (0: disabled), " +
+                "XRD engine ")
+        chains_box = wx.StaticBox(self, -1, _msg, size=size_StaticBox)
+        chains_box.SetFont(font)
+        chains_box_sizer = wx.StaticBoxSizer(chains_box, wx.VERTICAL)
+        in_chains_box_sizer = wx.GridBagSizer(hgap=10, vgap=0)
+
+        chains_label = {'nb_chains': u'chains', 'exchange': u'exchange',
+                        'nb_moves': u'moves', 'stop_window': u'window',
+                        'stop_tol': u'tol', 'stop_rejections': u'rejections',
+                        'stop_time': u'time (s)', 'pick': u'pick',
+                        'xrd_engine': u'engine'}
+        chains_choice = {'pick': p4R.Pick_choice,
+                         'xrd_engine': p4R.XRD_engine_choice}
+        self.TextcontrolChains = []
+        self.ComboChains = {}
+        col = 0
+        for k in p4R.s_GSA_chains:
+            txt_ = wx.StaticText(self, -1, label=chains_label[k],
+                                 size=(65, vStatictextsize))
+            txt_.SetFont(font_Statictext)
+            if k in chains_choice:
+                field = wx.ComboBox(self, size=size_text,
+                                    choices=chains_choice[k],
+                                    style=wx.CB_READONLY)
+                self.ComboChains[k] = field
+            else:
+                field = wx.TextCtrl(self, size=size_text,
+                                    validator=TextValidator(DIGIT_ONLY))
+                self.TextcontrolChains.append(field)
+            field.SetFont(font_TextCtrl)
+            in_chains_box_sizer.Add(txt_, pos=(col // 8, col % 8),
+                                    flag=flagSizer)
+            in_chains_box_sizer.Add(field, pos=(col // 8, col % 8 + 1),
+                                    flag=flagSizer)
+            col += 2
+
+        chains_box_sizer.Add(in_chains_box_sizer, 0, wx.ALL, 5)
+
         Leastsq_box = wx.StaticBox(self, -1, " Leastsq parameters ",
                                    size=size_StaticBox)
         Leastsq_box.SetFont(font)
@@ -644,6 +684,7 @@ class FitParametersPanel(wx.Panel):
 
         mastersizer.Add(Leastsq_box_sizer, 0, wx.ALL, 5)
         mastersizer.Add(AGSA_options_box_sizer, 0, wx.ALL, 5)
+        mastersizer.Add(chains_box_sizer, 0, wx.ALL, 5)
 #        mastersizer.Add(self.default_1, 0, wx.ALL, 5)
         mastersizer.Add(horsizer, 0, wx.ALL, 5)
         mastersizer.Add(txt_end, 0, wx.ALL, 5)
@@ -655,7 +696,8 @@ class FitParametersPanel(wx.Panel):
 
         self.TextcontrolGSA = [self.qa, self.qv, self.qt]
         self.TextcontrolLeastsq = [self.xtol, self.ftol, self.maxfev]
-        self.all_textControl = self.TextcontrolGSA + self.TextcontrolLeastsq
+        self.all_textControl = (self.TextcontrolGSA + self.TextcontrolLeastsq +
+                                self.TextcontrolChains)
 
         self.SetSizer(mastersizer)
         self.Layout()
@@ -672,6 +714,19 @@ class FitParametersPanel(wx.Panel):
         for k in p4R.s_leastsq:
             self.TextcontrolLeastsq[i].AppendText(str(a.AllDataDict[k]))
             i += 1
+        self.on_fill_chains()
+
+    def on_fill_chains(self):
+        a = P4Rm()
+        i = 0
+        for k, v in p4R.gsa_chains(a.AllDataDict).items():
+            if k == 'pick':
+                self.ComboChains[k].SetStringSelection(v)
+            elif k == 'xrd_engine':
+                self.ComboChains[k].SetSelection(v)
+            else:
+                self.TextcontrolChains[i].AppendText(str(v))
+                i += 1
 
     def on_refill_field(self):
         if self.open == 0:
@@ -688,6 +743,7 @@ class FitParametersPanel(wx.Panel):
             for k in p4R.s_leastsq:
                 self.TextcontrolLeastsq[i].AppendText(str(a.AllDataDict[k]))
                 i += 1
+            self.on_fill_chains()
 
     def on_apply_changes(self, event):
         pub.sendMessage(pubsub_Read_field_Bspline)
@@ -771,4 +827,16 @@ class FitParametersPanel(wx.Panel):
                 self.TextcontrolLeastsq[i].Clear()
                 self.TextcontrolLeastsq[i].AppendText(str(a.AllDataDict[k]))
                 i += 1
+            values = {
+                'pick': self.ComboChains['pick'].GetStringSelection(),
+                'xrd_engine': self.ComboChains['xrd_engine'].GetSelection()}
+            i = 0
+            for k in p4R.s_GSA_chains:
+                if k not in self.ComboChains:
+                    values[k] = self.TextcontrolChains[i].GetValue()
+                    i += 1
+            P4Rm.AllDataDict.update(p4R.gsa_chains(a.AllDataDict, values))
+            for ii in range(len(self.TextcontrolChains)):
+                self.TextcontrolChains[ii].Clear()
+            self.on_fill_chains()
         return dataFloat
@@ -14,8 +14,10 @@ from os.path import abspath
 from sys import platform as _platform
 
 from collections import OrderedDict
+from copy import copy
 
 from Functions4Radmax import f_Gauss, f_Lorentz, f_pVoigt, f_gbell, f_splitpV
+from GSA4Radmax import stop_criteria
 
 Application_name = "RaDMaX"
 filename = "Radmax"
@@ -78,6 +80,12 @@ database_dict = ['engine', 'session', 'Name', 'choice_state', 'choice_combo',
                  'date_1', 'date_2']
 
 FitAlgo_choice = ["GSA", "leastsq"]
+XRD_engine_choice = ["Serial", "Mobius", "Numba"]
+# seconds between two refreshes of the GUI during a fit
+progress_period = 0.25
+# seconds between two checkpoints of a running fit
+checkpoint_period = 60.
+checkpoint_ext = ".ckpt"
 FitSuccess = ["Success", "Aborted"]
 FitFunction = ["Gaussian", "Lorentzian", "Pseudo-Voigt",
                "Generalized bell", "Split-PV"]
@@ -135,6 +143,7 @@ Params4Radmax = ['sp', 'dwp', 'sp_pv', 'dwp_pv', 'sp_smooth', 'dwp_smooth',
                  'dw_basis_backup', 'strain_sm_ab_bkp', 'dw_sm_ab_bkp',
                  'scale_strain', 'scale_dw', 'strain_i',
                  'strain_shifted', 'DW_i', 'DW_shifted', 'par', 'resol',
+                 'resol_conv',
                  'stain_out', 'dw_out', 'thB_S_s', 'g0_s', 'gH_s', 'b_S_s',
                  'd_s', 'G_s', 'FH_s', 'FmH_s', 'F0_s', 'Vol_s',
                  'state_sp', 'state_dwp', 'func_profile', 'param_func_profile']
@@ -206,6 +215,38 @@ Exp_file_all_section = (s_crystal + s_data_file + s_experiment + s_material +
 # read from experiment file without check if value is a number or not
 Exp_read_only = s_bsplines + s_pv + s_GSA_expert + s_leastsq
 
+# optional section of the experiment file: GSA chains and moves (see
+# FitEngine4Radmax.Fit_model), stopping criteria (see
+# GSA4Radmax.Stop_criteria) and XRD engine of the fit (index in
+# XRD_engine_choice), the defaults being used for the projects saved
+# without it
+GSA_chains_section = 'GSA chains'
+GSAChainsDefault = OrderedDict([('nb_chains', 1), ('exchange', 0),
+                                ('nb_moves', 1), ('pick', 'best'),
+                                ('stop_window', 0), ('stop_tol', 1e-4),
+                                ('stop_rejections', 0), ('stop_time', 0.),
+                                ('xrd_engine', 0)])
+s_GSA_chains = list(GSAChainsDefault)
+Pick_choice = ['best', 'sample']
+
+
+def gsa_chains(data, values=None):
+    """
+    GSA chains settings of data, converted to the type of their default,
+    values (e.g. read from a file) replacing them; the defaults are used
+    for the settings missing in both
+    """
+    settings = OrderedDict()
+    for k, default in GSAChainsDefault.items():
+        val = data.get(k, default) if values is None else values.get(
+              k, data.get(k, default))
+        if isinstance(default, int):
+            val = int(float(val))
+        elif isinstance(default, float):
+            val = float(val)
+        settings[k] = val
+    return settings
+
 # =============================================================================
 # Radmax.ini section
 # =============================================================================
@@ -248,6 +289,7 @@ class P4Rm():
     ncolumnDB = len(database_dict)*[None]
 
     AllDataDict = OrderedDict(zip(Exp_file_all_section, ncolumnAllData))
+    AllDataDict.update(GSAChainsDefault)
     ParamDict = OrderedDict(zip(Params4Radmax, ncolumnParam))
     PathDict = OrderedDict(zip(Path4Radmax, ncolumnPath))
     DefaultDict = OrderedDict(zip(DefaultParam4Radmax, ncolumnDefault))
@@ -275,6 +317,9 @@ class P4Rm():
     checkGeometryField = 0
     checkInitialField = 0
     fit_type = ""
+    stop_reason = None
+    resume_fit = False
+    move_to_bounds = False
     lmfit_install = False
     fit_params = ""
 
@@ -285,7 +330,6 @@ class P4Rm():
 
     log_window_status = ""
 
-    gsa_loop = 0
     fitlive = 0
     residual_error = 0
 
@@ -313,3 +357,56 @@ class P4Rm():
     modelPv = ""
     pathfromDB = 0
     db_nb_line = 100
+
+
+# -----------------------------------------------------------------------------
+class Project():
+    """
+    Simulation state of one project: experiment, sample and fit settings
+    (AllDataDict), derived parameters (ParamDict), constants (ConstDict),
+    strain and DW profile functions (splinenumber), XRD engine and early
+    stopping of GSA (see GSA4Radmax.Stop_criteria).
+    Projects are independent of each other, the one edited in the GUI is
+    given by current_project(). Only the fit (FitEngine4Radmax), f_Refl,
+    f_plan and calcul_parameters take a project: the GUI panels still
+    edit the dictionaries of P4Rm, so a single project can be edited at a
+    time.
+    """
+    def __init__(self, AllDataDict=None, ParamDict=None, ConstDict=None,
+                 splinenumber=None, xrd_engine=0, stopping=None):
+        if AllDataDict is None:
+            AllDataDict = OrderedDict(zip(Exp_file_all_section,
+                                          len(Exp_file_all_section)*[""]))
+            AllDataDict.update(GSAChainsDefault)
+        if ParamDict is None:
+            ParamDict = OrderedDict(zip(Params4Radmax,
+                                        len(Params4Radmax)*[""]))
+        if ConstDict is None:
+            ConstDict = dict(P4Rm.ConstDict)
+        if splinenumber is None:
+            splinenumber = []
+        self.AllDataDict = AllDataDict
+        self.ParamDict = ParamDict
+        self.ConstDict = ConstDict
+        self.splinenumber = splinenumber
+        self.xrd_engine = xrd_engine
+        self.stopping = stopping
+
+    def snapshot(self):
+        """Copy of the project, unaffected by later changes of this one"""
+        return Project(
+            OrderedDict((k, copy(v)) for k, v in self.AllDataDict.items()),
+            OrderedDict((k, copy(v)) for k, v in self.ParamDict.items()),
+            dict(self.ConstDict), list(self.splinenumber), self.xrd_engine,
+            copy(self.stopping))
+
+
+def current_project():
+    """
+    Project edited in the GUI, sharing the dictionaries of P4Rm, its XRD
+    engine and GSA stopping criteria being those of AllDataDict
+    """
+    settings = gsa_chains(P4Rm.AllDataDict)
+    return Project(P4Rm.AllDataDict, P4Rm.ParamDict, P4Rm.ConstDict,
+                   P4Rm.splinenumber, settings['xrd_engine'],
+                   stop_criteria(settings))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: A_BOULLE & M_SOUILAH
+# Radmax project
+
+# =============================================================================
+# Simulation plan: layered stack seen by the reflectivity engines
+# =============================================================================
+
+from numpy import (arange, asarray, concatenate, ones, zeros, sin, tan, pi,
+                   sign)
+from Tools4Radmax import signe
+
+
+def f_substrate(b_S, thB_S, G, F0, FH, FmH, th):
+    """Amplitude reflected by a perfect semi-infinite crystal"""
+    eta = ((-b_S*(th-thB_S)*sin(2*thB_S) - 0.5*G*F0*(1-b_S)) /
+           ((abs(b_S)**0.5) * G * (FH*FmH)**0.5))
+    return (eta - signe(eta.real)*((eta*eta - 1)**0.5))
+
+
+# =============================================================================
+# Bottom boundaries of the stack
+# =============================================================================
+class Substrate():
+    """Perfect semi-infinite crystal below the stack"""
+    def __init__(self, b_S, thB_S, G, F0, FH, FmH, scale=1.):
+        self.b_S = b_S
+        self.thB_S = thB_S
+        self.G = G
+        self.F0 = F0
+        self.FH = FH
+        self.FmH = FmH
+        self.scale = scale
+
+    def amplitude(self, th):
+        return self.scale * f_substrate(self.b_S, self.thB_S, self.G,
+                                        self.F0, self.FH, self.FmH, th)
+
+
+class No_substrate():
+    """Nothing below the stack (free-standing film)"""
+    def amplitude(self, th):
+        return 0.
+
+
+# =============================================================================
+# Stack
+# =============================================================================
+class Simulation_plan():
+    """
+    Everything the fit engines need that does not depend on the strain and
+    DW profiles, computed once per fit: amplitude reflected by the bottom
+    boundary and list of layers, from the bottom to the surface.
+    Layer l follows the strain of slice index[l] of the profiles, has the
+    thickness lay_t[l], the DW factor DW0[l] + dDW[l]*DW[index[l]] and the
+    structure factors F0[l], FH[l], FmH[l].
+    """
+    def __init__(self, th, wl, phi, thB_S, G, bottom, index, lay_t, DW0,
+                 dDW, F0, FH, FmH):
+        self.th = asarray(th)
+        self.phi = phi
+        self.thB_S = thB_S
+        self.tan_thB_S = tan(thB_S)
+        self.s2 = sin(2*thB_S)
+        self.bottom = bottom
+        self.res0 = bottom.amplitude(self.th)
+
+        self.index = asarray(index, dtype=int)
+        self.lay_t = asarray(lay_t, dtype=float)
+        self.DW0 = asarray(DW0, dtype=float)
+        self.dDW = asarray(dDW, dtype=float)
+        self.L = len(self.index)
+
+        sqFF = (asarray(FH)*asarray(FmH))**0.5
+        self.KT = pi * G * sqFF * self.lay_t / wl
+        self.eF0 = 0.5 * G * asarray(F0)
+        self.Gsq = G * sqFF
+
+    def geometry(self, strain):
+        """Bragg angle, gamma 0 and gamma H of every layer"""
+        thB = self.thB_S - strain[..., self.index] * self.tan_thB_S
+        return thB, sin(thB - self.phi), -sin(thB + self.phi)
+
+    def slices(self, strain, DW):
+        """
+        Strain- and DW-dependent terms of every layer, with
+        eta = alpha.th + beta and T the reduced thickness.
+        strain and DW may be (K x N+1) stacks, the terms are then (K x L).
+        """
+        thB, g0, gH = self.geometry(strain)
+        b = g0 / gH
+        DW_l = self.DW0 + self.dDW * DW[..., self.index]
+        den = (abs(b)**0.5) * self.Gsq * DW_l
+        alpha = -b * self.s2 / den
+        beta = (b*thB*self.s2 - self.eF0*(1-b)) / den
+        T = self.KT * DW_l / (abs(g0*gH)**0.5)
+        return alpha, beta, T
+
+    def slices_jac(self, strain, DW):
+        """
+        Terms of slices() and their derivatives with respect to the strain
+        and DW values of the profile slice each layer comes from
+        """
+        thB, g0, gH = self.geometry(strain)
+        dg0 = sin(thB - self.phi + pi/2)
+        dgH = -sin(thB + self.phi + pi/2)
+        b = g0 / gH
+        db = (dg0*gH - g0*dgH) / (gH*gH)
+        P = g0 * gH
+        dP = dg0*gH + g0*dgH
+        DW_l = self.DW0 + self.dDW * DW[..., self.index]
+
+        den = (abs(b)**0.5) * self.Gsq * DW_l
+        dden = self.Gsq * DW_l * sign(b) * db / (2*(abs(b)**0.5))
+        alpha = -b * self.s2 / den
+        beta = (b*thB*self.s2 - self.eF0*(1-b)) / den
+        T = self.KT * DW_l / (abs(P)**0.5)
+
+        dthB = -self.tan_thB_S
+        d_strain = ((-db*self.s2 - alpha*dden) / den * dthB,
+                    ((db*thB + b)*self.s2 + self.eF0*db - beta*dden) /
+                    den * dthB,
+                    -0.5 * T * sign(P) * dP / abs(P) * dthB)
+        d_DW = (-alpha / DW_l * self.dDW,
+                -beta / DW_l * self.dDW,
+                T / DW_l * self.dDW)
+        return (alpha, beta, T), d_strain, d_DW
+
+
+# =============================================================================
+# Stacks of the RaDMaX geometries
+# =============================================================================
+def geometry_plan(choice, wl, t, N, phi, t_l, b_S, thB_S, G, F0, FH, FmH,
+                  th, b_Sub=None, thB_Sub=None, G_Sub=None, F0_Sub=None,
+                  FH_Sub=None, FmH_Sub=None, t_film=0., dw_film=1.):
+    """
+    Simulation plan of the geometry choice (see p4R.Geometry_choice):
+    0 damaged layer on the substrate of the same crystal, 1 thin film,
+    2 thick film (undamaged part of the film below the damaged layer),
+    3 thick film on a substrate of another crystal.
+    The undamaged part of a thick film follows the strain of the first
+    slice of the profile and has a fixed DW factor.
+    Without damaged layer (t = 0) the stack reduces to the bare substrate.
+    """
+    N = int(N)
+    F0 = asarray(F0)
+    FH = asarray(FH)
+    FmH = asarray(FmH)
+    if t <= 0:
+        bottom = Substrate(b_S, thB_S, G, F0[0], FH[0], FmH[0],
+                           (FH[0] / FmH[0])**0.5)
+        return Simulation_plan(th, wl, phi, thB_S, G, bottom, [], [], [], [],
+                               [], [], [])
+
+    if choice == 0:
+        bottom = Substrate(b_S, thB_S, G, F0[0], FH[0], FmH[0])
+    elif choice == 3:
+        bottom = Substrate(b_Sub, thB_Sub, G_Sub, F0_Sub[0], FH_Sub[0],
+                           FmH_Sub[0])
+    else:
+        bottom = No_substrate()
+    if choice != 3:
+        dw_film = 1.
+
+    index = arange(1, N+1)
+    lay_t = ones(N) * t_l
+    DW0 = zeros(N)
+    dDW = ones(N) * dw_film
+    if choice == 2 or choice == 3:
+        index = concatenate(([0], index))
+        lay_t = concatenate(([t_film - t], lay_t))
+        DW0 = concatenate(([dw_film], DW0))
+        dDW = concatenate(([0.], dDW))
+    return Simulation_plan(th, wl, phi, thB_S, G, bottom, index, lay_t, DW0,
+                           dDW, F0[index], FH[index], FmH[index])
@@ -90,6 +90,7 @@ from Color4Radmax import ColorWindow
 from FitReport4Radmax import FitReportWindow
 from Calcul4Radmax import Calcul4Radmax
 from Read4Radmax import SaveFile4Diff
+from Tools4Radmax import structure_library
 from DB4Radmax import DataBasePanel, DataBaseManagement
 
 from Settings4Radmax import LogSaver, LogWindow
@@ -428,8 +429,9 @@ class MainFrame(wx.Frame):
                     P4Rm.DefaultDict[k] = False
             else:
                 P4Rm.DefaultDict[k] = float(a.DefaultDict[k])
-        if os.listdir(p4R.structures_name):
-            P4Rm.crystal_list = sorted(list(os.listdir(p4R.structures_name)))
+        crystals = structure_library(p4R.structures_name).names()
+        if crystals:
+            P4Rm.crystal_list = crystals
 
         if a.DefaultDict['use_database']:
             self.m_menuhide_show_database.Check(True)
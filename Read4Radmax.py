@@ -102,7 +102,7 @@ class ReadFile():
                 test_true_false.append(var)
         difference = self.diff(section_name, test_true_false)
         if difference == []:
-            for nameofsection in parser.sections():
+            for nameofsection in self.structure_section:
                 for name, value in parser.items(nameofsection):
                     var = parser.get(nameofsection, name)
                     lecture_fichier.append(var)
@@ -118,7 +118,7 @@ class ReadFile():
         parser.read(filename)
         nulle = self.all_indices('', lecture_fichier)
         if nulle == []:
-            for nameofsection in parser.sections():
+            for nameofsection in self.structure_section:
                 for name, value in parser.items(nameofsection):
                     var = parser.get(nameofsection, name)
                     result_values.append(var)
@@ -133,6 +133,18 @@ class ReadFile():
                 logger.log(logging.ERROR, "Missing data from: " +
                            str(section_name[chare]))
 
+    def read_gsa_chains(self, filename):
+        """
+        GSA chains settings of the optional section of the project file,
+        the defaults for the settings it does not give
+        """
+        parser = SafeConfigParser()
+        parser.read(filename)
+        values = {}
+        if parser.has_section(p4R.GSA_chains_section):
+            values = dict(parser.items(p4R.GSA_chains_section))
+        return p4R.gsa_chains({}, values)
+
     def read_result_value(self):
         if result_values != []:
             return result_values
@@ -324,6 +336,10 @@ class SaveFile4Diff():
             for l in range(r):
                 parser.set(p4R.Exp_file_section[i], new_section_name[l],
                            str(a.AllDataDict[new_section_name[l]]))
+        if not parser.has_section(p4R.GSA_chains_section):
+            parser.add_section(p4R.GSA_chains_section)
+        for k, v in p4R.gsa_chains(a.AllDataDict).items():
+            parser.set(p4R.GSA_chains_section, k, str(v))
         parser.write(open(filename_, 'w'))
 
     def on_update_config_file(self, filename, data, sequence):
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: A_BOULLE & M_SOUILAH
+# Radmax project
+
+# =============================================================================
+# Compiled table of the atomic scattering factors
+# =============================================================================
+
+import os
+import json
+import numpy as np
+
+import Parameters4Radmax as p4R
+from Tools4Radmax import csv2dic_f0, csv2dic_el
+
+import logging
+logger = logging.getLogger(__name__)
+
+table_name = "f0f1f2.bin"
+magic = b"RADMAX-F0F1F2 1\n"
+
+# energy (eV) of a photon of wavelength 1 Angstrom
+hc_e = 6.62606957e-34 * 2.99792458e8 / (1e-10 * 1.602e-19)
+
+
+def table_sources(directory):
+    """Text files compiled in the binary table"""
+    return [os.path.join(directory, name) for name in os.listdir(directory)
+            if name.endswith(".txt") or name.endswith(".csv")]
+
+
+def compile_table(directory, path):
+    """
+    Compile elements.csv, f0_all.csv and the f1/f2 tables of the elements
+    (<element>.txt) of directory in one binary file: a JSON header giving
+    the names and positions of the blocks, then the float64 data, aligned
+    so that it can be memory-mapped.
+    """
+    elements = csv2dic_el(os.path.join(directory, "elements.csv"))
+    f0 = csv2dic_f0(os.path.join(directory, "f0_all.csv"))
+    ions = sorted(f0)
+    blocks = [np.array([f0[ion] for ion in ions]).ravel()]
+    f1f2 = {}
+    start = blocks[0].size
+    for el in sorted(elements):
+        name = os.path.join(directory, el + ".txt")
+        if not os.path.isfile(name):
+            continue
+        try:
+            data = np.loadtxt(name)
+        except ValueError:
+            logger.log(logging.WARNING, "Unreadable f1f2 table: " + name)
+            continue
+        # interp1d sorted the energies, keep the same order
+        data = data[np.argsort(data[:, 0], kind='mergesort')]
+        blocks.append(data.T.ravel())
+        f1f2[el] = [start, len(data)]
+        start += data.size
+    header = {'elements': dict((k, int(v)) for k, v in elements.items()),
+              'ions': ions, 'f1f2': f1f2, 'size': start}
+    text = json.dumps(header).encode('ascii')
+    pad = (-(len(magic) + len(text) + 1)) % 8
+    with open(path + ".tmp", 'wb') as f:
+        f.write(magic)
+        f.write(text + b" " * pad + b"\n")
+        f.write(np.concatenate(blocks).astype('<f8').tobytes())
+    # never leave a truncated table behind
+    os.replace(path + ".tmp", path)
+
+
+class Scattering_table():
+    """
+    Memory-mapped binary table of the scattering factors, compiled from
+    the text files of directory on first use and each time one of them is
+    newer than the binary file.
+    """
+    def __init__(self, directory=None, path=None):
+        if directory is None:
+            directory = p4R.struc_factors
+        if path is None:
+            path = os.path.join(directory, table_name)
+        sources = table_sources(directory)
+        if (not os.path.isfile(path) or os.path.getmtime(path) <
+                max(os.path.getmtime(name) for name in sources)):
+            compile_table(directory, path)
+        with open(path, 'rb') as f:
+            if f.readline() != magic:
+                raise IOError("Not a RaDMaX scattering table: " + path)
+            header = json.loads(f.readline().decode('ascii'))
+            offset = f.tell()
+        data = np.memmap(path, dtype='<f8', mode='r', offset=offset,
+                         shape=(header['size'],))
+        self.Z = header['elements']
+        self.ions = dict((ion, i) for i, ion in enumerate(header['ions']))
+        self.f0_coeff = data[:11*len(self.ions)].reshape(-1, 11)
+        self.f1f2_rows = dict((el, data[s:s+3*n].reshape(3, n))
+                              for el, (s, n) in header['f1f2'].items())
+
+    def f0(self, ions, q):
+        """
+        Atomic scattering factors f0 of the ions (list of names) for the
+        values q = sin(th)/wl, as a (len(ions) x len(q)) array
+        """
+        c = self.f0_coeff[[self.ions[ion] for ion in ions]]
+        s2 = np.atleast_1d(np.asarray(q, dtype=float))**2
+        return (c[:, 5, None] +
+                (c[:, :5, None] * np.exp(-c[:, 6:, None] * s2)).sum(axis=1))
+
+    def f1f2(self, elements, E):
+        """
+        Anomalous terms f1 - Z + i.f2 of the elements for the energies E
+        (eV), as a (len(elements) x len(E)) array
+        """
+        E = np.atleast_1d(np.asarray(E, dtype=float))
+        out = np.zeros((len(elements), len(E)), dtype=complex)
+        for i, el in enumerate(elements):
+            Et, f1, f2 = self.f1f2_rows[el]
+            if E.min() < Et[0] or E.max() > Et[-1]:
+                raise ValueError("Energy out of the f1f2 table of " + el)
+            out[i] = (np.interp(E, Et, f1) - self.Z[el] +
+                      1j*np.interp(E, Et, f2))
+        return out
+
+    def asf(self, ions, th, wl):
+        """
+        Scattering factors of the ions at the angles th and at th = 0 for
+        the wavelengths wl (Angstrom), th and wl being broadcast together;
+        ion charges (e.g. O2-) only matter for f0
+        """
+        th, wl = np.broadcast_arrays(np.atleast_1d(th), np.atleast_1d(wl))
+        elements = [ion[:-2] if len(ion[:-2]) > 0 else ion for ion in ions]
+        anomalous = self.f1f2(elements, hc_e / wl.ravel())
+        f = self.f0(ions, np.sin(th.ravel()) / wl.ravel()) + anomalous
+        f0 = self.f0(ions, np.zeros(wl.size)) + anomalous
+        return f.reshape((-1,) + th.shape), f0.reshape((-1,) + th.shape)
+
+
+scattering_tables = {}
+
+
+def scattering_table(directory=None):
+    """Scattering table of directory, opened once per session"""
+    if directory is None:
+        directory = p4R.struc_factors
+    if directory not in scattering_tables:
+        scattering_tables[directory] = Scattering_table(directory)
+    return scattering_tables[directory]
@@ -3,9 +3,10 @@
 # Author: A_BOULLE & M_SOUILAH
 # Radmax project
 
+import os
 import csv
 from scipy import cos, sin, sqrt, pi
-from numpy import where, zeros, array, vstack
+from numpy import where, zeros, array
 
 
 def find(x, Z):
@@ -75,32 +76,70 @@ def read_structure(nom):
     '''Read the structure file and extract element names and coordinates'''
     try:
         with open(nom, 'r') as f:
-            first = True
-            i = -1
+            elements = f.readline().split()
+            blocks = []
             for line in f:
-                if first:
-                    elements = line.split()
-                    xyz = [None]*len(elements)
-                    first = False
-                else:
-                    if line.startswith("#"):
-                        i += 1
-                        new = True
-                        xyz[i] = zeros(3)
-                    else:
-                        x, y, z = line.split()
-                        if new:
-                            xyz[i] = array([float(x), float(y), float(z)])
-                            new = False
-                        else:
-                            xyz[i] = vstack((xyz[i], array([float(x), float(y),
-                                             float(z)])))
+                if line.startswith("#"):
+                    blocks.append([])
+                elif line.strip():
+                    blocks[-1].append(line.split())
+        xyz = [None]*len(elements)
+        for i, rows in enumerate(blocks[:len(elements)]):
+            if rows:
+                xyz[i] = array(rows, dtype=float).reshape(-1, 3)
+            else:
+                # an empty block stands for one atom at the origin
+                xyz[i] = zeros((1, 3))
         return elements, xyz
     except IOError:
         print ("Cannot open file")
         return False
 
 
+class Structure_library():
+    '''
+    Index of a structures directory: sorted list of the files and parsed
+    content (elements, coordinates) of the structures already read, with
+    the modification dates used to refresh them when files change
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.mtime = None
+        self.crystals = []
+        self.entries = {}
+
+    def names(self):
+        '''Sorted names of the structure files'''
+        mtime = os.path.getmtime(self.directory)
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.crystals = sorted(os.listdir(self.directory))
+            for name in list(self.entries):
+                if name not in self.crystals:
+                    del self.entries[name]
+        return list(self.crystals)
+
+    def structure(self, name):
+        '''Elements and coordinates of a structure, parsed once'''
+        path = os.path.join(self.directory, name)
+        mtime = os.path.getmtime(path)
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, read_structure(path))
+            self.entries[name] = entry
+        return entry[1]
+
+
+structure_libraries = {}
+
+
+def structure_library(directory):
+    '''Index of a structures directory, kept for the whole session'''
+    if directory not in structure_libraries:
+        structure_libraries[directory] = Structure_library(directory)
+    return structure_libraries[directory]
+
+
 def dic2file(dictionnaire, nom_fichier):
     '''write file from dictionnary'''
     try: